@@ -0,0 +1,346 @@
+"""بنچمارک بار سرتاسری bot.py بدون تماس با تلگرام یا ساندکلود واقعی
+
+یک Bot API جعلی (getMe, getUpdates, getFile, دانلود فایل, sendAudio, sendMessage,
+editMessageText, deleteMessage) با تأخیر و خطای 429 قابل تنظیم و یک منبع HTTP محلی
+برای yt-dlp راه‌اندازی می‌شود. سپس پیام‌ها از مسیر handle_message و صف، توسط
+queue_worker / process_audio_file / process_soundcloud_url پردازش می‌شوند.
+
+اجرا:
+    python benchmarks/loadtest.py --files 60 --workers 4 --formats mp3 flac --latency-ms 50 --flood-rate 0.02
+    python benchmarks/loadtest.py --files 0 --playlists 3 --playlist-tracks 8
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import asyncio
+import argparse
+import logging
+import resource
+import tempfile
+import itertools
+import statistics
+import subprocess
+import collections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = "123456:LOADTEST"
+CHAT_ID = 1000
+FLOOD_METHODS = {"sendAudio", "editMessageText", "deleteMessage"}
+FORMAT_MIME = {".mp3": "audio/mpeg", ".flac": "audio/flac", ".m4a": "audio/mp4"}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=30, help="تعداد فایل‌های صوتی ارسالی")
+    parser.add_argument("--formats", nargs="+", default=["mp3"], choices=["mp3", "flac", "m4a"])
+    parser.add_argument("--size-mb", type=float, default=8.0, help="حجم تقریبی هر فایل")
+    parser.add_argument("--chats", type=int, default=3, help="تعداد کاربران (چت) ارسال‌کننده")
+    parser.add_argument("--dup-ratio", type=float, default=0.0, help="نسبت فایل‌های تکراری (برای سنجش کش بازنشر)")
+    parser.add_argument("--playlists", type=int, default=0, help="تعداد پلی‌لیست‌های yt-dlp")
+    parser.add_argument("--playlist-tracks", type=int, default=5)
+    parser.add_argument("--album", action="store_true", help="انتشار پلی‌لیست‌ها در حالت آلبوم (SC_ALBUM_MODE)")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="تأخیر هر درخواست Bot API")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0.0, help="شبیه‌سازی پهنای باند دانلود/آپلود (0 = نامحدود)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="احتمال پاسخ 429 به آپلود/ویرایش/حذف")
+    parser.add_argument("--port", type=int, default=18900)
+    return parser.parse_args()
+
+# ----------------- تولید فایل‌های صوتی آزمایشی -----------------
+def make_audio(path: str, ext: str, size: int):
+    if shutil.which("ffmpeg") and ext != ".mp3":
+        codec = {".flac": ["-c:a", "flac"], ".m4a": ["-c:a", "aac", "-b:a", "256k"]}[ext]
+        # مدت تقریبی بر اساس بیت‌ریت هر فرمت
+        seconds = max(1, int(size / {".flac": 100_000, ".m4a": 32_000}[ext]))
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"anoisesrc=d={seconds}", "-ac", "2", *codec, path],
+            check=True
+        )
+        return
+    if ext == ".mp3":
+        with open(path, "wb") as f:
+            f.write(b"\xff\xfb\x90\x00" + os.urandom(size))
+    elif ext == ".flac":
+        # هدر حداقلی FLAC (STREAMINFO + padding) برای mutagen؛ بدنه داده تصادفی است
+        streaminfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6 + bytes([0x0a, 0xc4, 0x42, 0xf0]) + b"\x00" * 20
+        with open(path, "wb") as f:
+            f.write(b"fLaC" + b"\x00" + (34).to_bytes(3, "big") + streaminfo)
+            f.write(b"\x81" + (4096).to_bytes(3, "big") + b"\x00" * 4096)
+            f.write(b"\xff\xf8" + os.urandom(size))
+    else:
+        raise SystemExit("❌ تولید فایل M4A به ffmpeg نیاز دارد.")
+
+# ----------------- Bot API جعلی -----------------
+class FakeTelegram:
+    def __init__(self, args, media_dir: str):
+        self.args = args
+        self.media_dir = media_dir
+        self.files = {}                      # file_id -> (file_unique_id, path)
+        self.message_ids = collections.defaultdict(lambda: itertools.count(1))
+        self.counters = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.media_items = 0
+
+    def next_message_id(self, chat_id) -> int:
+        return next(self.message_ids[str(chat_id)])
+
+    async def _throttle(self, nbytes: int):
+        if self.args.bandwidth_mbps > 0:
+            await asyncio.sleep(nbytes * 8 / (self.args.bandwidth_mbps * 1_000_000))
+
+    def _message(self, chat_id, **extra) -> dict:
+        chat_type = "channel" if str(chat_id).startswith("@") else "private"
+        chat = {"id": -100123 if chat_type == "channel" else int(chat_id), "type": chat_type}
+        if chat_type == "channel":
+            chat["username"] = str(chat_id).lstrip("@")
+        return {"message_id": self.next_message_id(chat_id), "date": int(time.time()), "chat": chat, **extra}
+
+    async def handle_api(self, request):
+        from aiohttp import web
+        method = request.match_info["method"]
+        self.counters[method] += 1
+        await asyncio.sleep(self.args.latency_ms / 1000)
+
+        # خطای 429 فقط روی متدهایی که ربات از مسیر زمان‌بند/تلاش مجدد می‌فرستد
+        if method in FLOOD_METHODS and random.random() < self.args.flood_rate:
+            self.counters["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1},
+            }, status=429)
+
+        form = await request.post() if request.can_read_body else {}
+        params = {}
+        for key, value in form.items():
+            if hasattr(value, "file"):
+                data = value.file.read()
+                self.bytes_in += len(data)
+                await self._throttle(len(data))
+                params[key] = data
+            else:
+                params[key] = value
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif method == "getUpdates":
+            await asyncio.sleep(1)
+            result = []
+        elif method == "getFile":
+            file_id = params["file_id"]
+            unique_id, path = self.files[file_id]
+            result = {"file_id": file_id, "file_unique_id": unique_id, "file_size": os.path.getsize(path),
+                      "file_path": f"music/{os.path.basename(path)}"}
+        elif method == "sendAudio":
+            audio = params.get("audio")
+            uploaded = audio if isinstance(audio, bytes) else b""
+            file_id = f"up_{len(self.files)}"
+            self.files[file_id] = (f"upu_{len(self.files)}", os.devnull)
+            result = self._message(params["chat_id"], audio={
+                "file_id": file_id, "file_unique_id": self.files[file_id][0],
+                "duration": int(params.get("duration") or 0), "file_size": len(uploaded),
+            })
+        elif method == "sendMediaGroup":
+            result = []
+            for media in json.loads(params["media"]):
+                self.media_items += 1
+                ref = media["media"]
+                uploaded = params.get(ref[len("attach://"):]) if ref.startswith("attach://") else b""
+                file_id = f"up_{len(self.files)}"
+                self.files[file_id] = (f"upu_{len(self.files)}", os.devnull)
+                result.append(self._message(params["chat_id"], media_group_id="1", audio={
+                    "file_id": file_id, "file_unique_id": self.files[file_id][0],
+                    "duration": int(media.get("duration") or 0), "file_size": len(uploaded or b""),
+                }))
+        elif method == "sendMessage":
+            result = self._message(params["chat_id"], text=params.get("text", ""))
+        elif method == "editMessageText":
+            result = self._message(params["chat_id"], text=params.get("text", ""))
+            result["message_id"] = int(params["message_id"])
+        elif method == "deleteMessage":
+            result = True
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request):
+        from aiohttp import web
+        path = os.path.join(self.media_dir, os.path.basename(request.match_info["path"]))
+        size = os.path.getsize(path)
+        # درخواست‌های Range فقط بخشی از فایل را دریافت می‌کنند
+        rng = request.http_range
+        if rng.start is not None or rng.stop is not None:
+            size = len(range(size)[rng])
+        self.bytes_out += size
+        await self._throttle(size)
+        return web.FileResponse(path)
+
+# ----------------- اجرای بنچمارک -----------------
+async def sample_resources(bot_module, stats: dict, stop: asyncio.Event):
+    while not stop.is_set():
+        stats["disk_peak"] = max(stats["disk_peak"], bot_module.temp_disk_usage())
+        rss = 0
+        for proc in list(bot_module.ytdl_pool.procs):
+            try:
+                with open(f"/proc/{proc.pid}/status") as f:
+                    rss += next(int(l.split()[1]) for l in f if l.startswith("VmRSS")) * 1024
+            except (OSError, StopIteration):
+                pass
+        stats["ytdl_rss_peak"] = max(stats["ytdl_rss_peak"], rss)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+async def run(args, work_dir: str):
+    from aiohttp import web
+    from telegram import Update
+    from telegram.ext import Application
+    import bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # قطع اتصال درخواست‌های نیمه‌کاره هنگام خاموشی، خطای سرور جعلی محسوب نمی‌شود
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+
+    media_dir = os.path.join(work_dir, "media")
+    os.makedirs(media_dir)
+    fake = FakeTelegram(args, media_dir)
+    size = int(args.size_mb * 1024 * 1024)
+
+    # فایل‌های تلگرام
+    messages = []
+    unique_files = max(1, int(args.files * (1 - args.dup_ratio)))
+    for i in range(args.files):
+        n = i if i < unique_files else random.randrange(unique_files)
+        ext = "." + args.formats[n % len(args.formats)]
+        path = os.path.join(media_dir, f"track_{n}{ext}")
+        if not os.path.exists(path):
+            make_audio(path, ext, size)
+        fake.files[f"f{n}"] = (f"u{n}", path)
+        messages.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1, "date": int(time.time()),
+                "chat": {"id": CHAT_ID + i % args.chats, "type": "private"},
+                "from": {"id": CHAT_ID + i % args.chats, "is_bot": False, "first_name": "bench"},
+                "audio": {"file_id": f"f{n}", "file_unique_id": f"u{n}", "duration": 180,
+                          "file_name": f"Track {n}{ext}", "file_size": os.path.getsize(path),
+                          "mime_type": FORMAT_MIME[ext]},
+            },
+        })
+
+    # پلی‌لیست‌های محلی برای yt-dlp (استخراج‌کننده generic از تگ‌های audio صفحه HTML)
+    for p in range(args.playlists):
+        for t in range(args.playlist_tracks):
+            make_audio(os.path.join(media_dir, f"pl{p}_{t}.mp3"), ".mp3", size)
+        with open(os.path.join(media_dir, f"set{p}.html"), "w") as f:
+            f.write(f"<html><head><title>set {p}</title></head><body>")
+            f.write("".join(f'<audio src="/src/pl{p}_{t}.mp3"></audio>' for t in range(args.playlist_tracks)))
+            f.write("</body></html>")
+
+    web_app = web.Application(client_max_size=2 * 1024 ** 3)
+    web_app.router.add_route("*", "/bot{token}/{method}", fake.handle_api)
+    web_app.router.add_get("/file/bot{token}/{path:.+}", fake.handle_file)
+    web_app.router.add_static("/src", media_dir)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+    base = f"http://127.0.0.1:{args.port}"
+
+    app = (
+        Application.builder().token(TOKEN)
+        .base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+        .read_timeout(120).write_timeout(120)
+        .build()
+    )
+    await app.initialize()
+
+    # نمونه‌های خام تأخیر هر مرحله برای محاسبه صدک‌ها
+    samples = collections.defaultdict(list)
+    original_observe = bot.STAGE_SECONDS.observe
+    def observe(value, **labels):
+        samples[labels.get("stage", "?")].append(value)
+        original_observe(value, **labels)
+    bot.STAGE_SECONDS.observe = observe
+
+    stats = {"disk_peak": 0, "ytdl_rss_peak": 0}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_resources(bot, stats, stop))
+    scheduler = asyncio.create_task(bot.outbound_scheduler.run(app.bot))
+    bot.worker_pool.min_workers = bot.worker_pool.max_workers = args.workers
+    bot.worker_pool.start(app, args.workers)
+
+    total_tasks = len(messages) + args.playlists
+    started = time.perf_counter()
+    for data in messages:
+        await bot.handle_message(Update.de_json(data, app.bot), None)
+    for p in range(args.playlists):
+        status = await app.bot.send_message(CHAT_ID, "playlist")
+        await bot.task_queue.put(CHAT_ID, status.message_id, "soundcloud_url", f"{base}/src/set{p}.html", bot.PRIORITY_PLAYLIST)
+
+    while sum(bot.TASKS_TOTAL.values.values()) < total_tasks:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await sampler
+    for task in bot.worker_pool.workers.values():
+        task.cancel()
+    scheduler.cancel()
+    await bot.ytdl_pool.close()
+    await bot.RangedDownload.close()
+    await app.shutdown()
+    await runner.cleanup()
+
+    posted_tracks = fake.counters["sendAudio"] + fake.media_items
+    print("\n=========== نتیجه بنچمارک ===========")
+    print(f"tasks: {total_tasks}  workers: {args.workers}  elapsed: {elapsed:.2f}s")
+    print(f"tasks/min: {total_tasks / elapsed * 60:.1f}   uploads/min: {posted_tracks / elapsed * 60:.1f}")
+    results = collections.Counter()
+    for key, value in bot.TASKS_TOTAL.values.items():
+        labels = dict(key)
+        results[f"{labels['type']}/{labels['result']}"] += int(value)
+    print(f"results: {dict(results)}")
+    print(f"{'stage':<16}{'n':>6}{'p50 ms':>12}{'p95 ms':>12}")
+    for stage, values in sorted(samples.items()):
+        print(f"{stage:<16}{len(values):>6}{percentile(values, 0.5) * 1000:>12.1f}{percentile(values, 0.95) * 1000:>12.1f}")
+    print(f"api calls: {dict(fake.counters)}")
+    print(f"bytes served: {fake.bytes_out / 2**20:.1f} MB   bytes uploaded: {fake.bytes_in / 2**20:.1f} MB")
+    print(f"repost cache: {bot.repost_cache.stats()}")
+    print(f"peak RSS (bot): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB"
+          f"   peak RSS (yt-dlp workers): {stats['ytdl_rss_peak'] / 2**20:.1f} MB")
+    print(f"temp disk high-water: {stats['disk_peak'] / 2**20:.1f} MB")
+
+def main():
+    args = parse_args()
+    args.formats = [f.lstrip(".") for f in args.formats]
+    work_dir = tempfile.mkdtemp(prefix="bench_load_")
+
+    # تنظیمات bot.py از متغیرهای محیطی و پیش از import خوانده می‌شوند
+    os.environ["STATE_DB"] = os.path.join(work_dir, "state.db")
+    os.environ["TEMP_ROOT"] = os.path.join(work_dir, "tmp")
+    os.environ["WORKERS"] = str(args.workers)
+    os.environ["SC_ALBUM_MODE"] = "1" if args.album else "0"
+    os.environ.setdefault("BOT_TOKEN", TOKEN)
+    os.chdir(ROOT)
+    import bot  # noqa: F401  (مسیر کاور نسبت به ریشه پروژه محاسبه می‌شود)
+    os.chdir(work_dir)
+    try:
+        asyncio.run(run(args, work_dir))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
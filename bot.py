@@ -1,24 +1,99 @@
 import os
 import asyncio
 import logging
+import logging.handlers
+import queue
+import atexit
 import time
+BOOT_STARTED = time.perf_counter()
 import shutil
 import uuid
-import static_ffmpeg
-from aiohttp import web
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-import yt_dlp
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, TPE1, TIT2, TALB, COMM, ID3NoHeaderError
-from mutagen.flac import FLAC, Picture
-from mutagen.mp4 import MP4, MP4Cover
+import socket
+import sqlite3
+import threading
+import json
+import types
+import collections
+import functools
+import itertools
+import contextlib
+import hashlib
+import concurrent.futures
+import io
+import sys
+
+# زمان هر مرحله راه‌اندازی (ثانیه)؛ مراحل import مدت خود import و بقیه فاصله از شروع پروسه هستند
+startup_timings = {}
+
+@contextlib.contextmanager
+def timed_import(name: str):
+    started = time.perf_counter()
+    yield
+    startup_timings.setdefault(f"import_{name}", time.perf_counter() - started)
+
+def mark_startup(phase: str):
+    startup_timings.setdefault(phase, time.perf_counter() - BOOT_STARTED)
+
+# ماژول‌های سنگین کم‌کاربرد (mutagen، static_ffmpeg و yt-dlp در پروسه جدا) در اولین استفاده یا گرم‌سازی پس‌زمینه بارگذاری می‌شوند
+with timed_import("aiohttp"):
+    import aiohttp
+    from aiohttp import web
+with timed_import("telegram"):
+    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio
+    from telegram.error import RetryAfter, BadRequest, NetworkError
+    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 
 # ----------------- تنظیمات لاگینگ پیشرفته -----------------
-logging.basicConfig(
-    format='%(asctime)s - [%(levelname)s] - [%(name)s:%(lineno)d] - %(message)s',
-    level=logging.DEBUG
-)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()   # سطح لاگ (DEBUG فقط برای عیب‌یابی)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")         # json (یک شیء در هر خط) یا text
+
+class TextLogFormatter(logging.Formatter):
+    """قالب متنی قبلی؛ فیلدهای ساختاریافته (extra={"fields": ...}) به صورت JSON به انتهای خط اضافه می‌شوند"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        return f"{line} | {json.dumps(fields, ensure_ascii=False, default=str)}" if fields else line
+
+class JsonLogFormatter(logging.Formatter):
+    """هر رکورد لاگ یک خط JSON؛ فیلدهای ساختاریافته در سطح اول شیء قرار می‌گیرند"""
+
+    def format(self, record):
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "line": record.lineno,
+            "msg": record.getMessage(),
+        }
+        payload.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """فقط رکورد را در صف می‌گذارد؛ قالب‌بندی و نوشتن روی خروجی در thread جدای QueueListener انجام می‌شود"""
+
+    def prepare(self, record):
+        # پیام و traceback همین‌جا ثابت می‌شوند تا آرگومان‌ها و فریم‌های قابل تغییر وارد thread دیگر نشوند
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+log_output = logging.StreamHandler()
+if LOG_FORMAT == "json":
+    log_output.setFormatter(JsonLogFormatter())
+else:
+    log_output.setFormatter(TextLogFormatter('%(asctime)s - [%(levelname)s] - [%(name)s:%(lineno)d] - %(message)s'))
+log_listener = logging.handlers.QueueListener(queue.SimpleQueue(), log_output, respect_handler_level=True)
+logging.basicConfig(handlers=[BackgroundLogHandler(log_listener.queue)], level=LOG_LEVEL)
+log_listener.start()
+# رکوردهای باقی‌مانده در صف هنگام خروج نوشته می‌شوند
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # خاموش کردن لاگ‌های اضافی شبکه جهت خلوت ماندن کنسول
@@ -26,28 +101,143 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("telegram").setLevel(logging.INFO)
 
-static_ffmpeg.add_paths()
-
 # ----------------- تنظیمات متغیرهای محیطی و ثابت‌ها -----------------
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 CHANNEL_ID = "@voxxboxx"            # آیدی کانال شما
 COVER_PATH = "cover.jpg"            # تصویر کاور در ریشه پروژه
-NUM_WORKERS = 3                     # تعداد پردازش همزمان (ورکرها)
+NUM_WORKERS = int(os.environ.get("WORKERS", 3))                       # تعداد اولیه ورکرهای صف
+MIN_WORKERS = int(os.environ.get("MIN_WORKERS", 1))                    # حداقل ورکرها هنگام خلوتی صف
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", NUM_WORKERS * 2))      # حداکثر ورکرها هنگام شلوغی صف
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 3))  # دانلودهای همزمان (تلگرام و ساندکلود)
+TAG_CONCURRENCY = int(os.environ.get("TAG_CONCURRENCY", os.cpu_count() or 2))  # ویرایش متادیتای همزمان
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", 2))      # آپلودهای همزمان به کانال
+STATE_DB_PATH = os.environ.get("STATE_DB", "bot_state.db")            # دیتابیس وضعیت ماندگار ربات
+COORDINATION = os.environ.get("COORDINATION", "local")                 # local (تک‌نسخه‌ای) یا sqlite (چند نسخه روی STATE_DB مشترک)
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"  # شناسه این نسخه در اجاره‌ها
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 60))                     # مدت اعتبار اجاره وظیفه/اسلات بدون heartbeat (ثانیه)
+QUEUE_POLL_INTERVAL = float(os.environ.get("QUEUE_POLL_INTERVAL", 1))  # فاصله بررسی صف مشترک برای وظایف نسخه‌های دیگر
+GLOBAL_DOWNLOAD_CONCURRENCY = int(os.environ.get("GLOBAL_DOWNLOAD_CONCURRENCY", 0))  # سقف دانلود همزمان کل نسخه‌ها (0 = بدون سقف)
+GLOBAL_UPLOAD_CONCURRENCY = int(os.environ.get("GLOBAL_UPLOAD_CONCURRENCY", 0))      # سقف آپلود همزمان کل نسخه‌ها (0 = بدون سقف)
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 5000))     # سقف تعداد رکوردهای کش بازنشر
+CACHE_MAX_AGE_DAYS = float(os.environ.get("CACHE_MAX_AGE_DAYS", 30))   # حداکثر عمر هر رکورد کش (روز)
+TASK_MAX_ATTEMPTS = int(os.environ.get("TASK_MAX_ATTEMPTS", 3))        # سقف تلاش برای هر وظیفه پس از ری‌استارت
+JOB_TRACE_MAX_SPANS = int(os.environ.get("JOB_TRACE_MAX_SPANS", 100))  # سقف بازه‌های جزئی در رکورد خلاصه هر وظیفه
+SC_TRACK_TIMEOUT = float(os.environ.get("SC_TRACK_TIMEOUT", 240))      # تایم‌اوت دانلود هر ترک ساندکلود (ثانیه)
+SC_TRACK_RETRIES = int(os.environ.get("SC_TRACK_RETRIES", 2))          # تعداد تلاش دانلود هر ترک
+SC_PIPELINE_WINDOW = int(os.environ.get("SC_PIPELINE_WINDOW", 3))      # حداکثر ترک‌های در جریان هر پلی‌لیست
+SC_ALBUM_MODE = os.environ.get("SC_ALBUM_MODE", "0") == "1"            # انتشار پلی‌لیست به صورت آلبوم (media group)
+SC_ALBUM_SIZE = max(2, min(10, int(os.environ.get("SC_ALBUM_SIZE", 10))))  # تعداد ترک هر آلبوم (حداکثر ۱۰)
+ALBUM_UPLOAD_MIN_KBPS = float(os.environ.get("ALBUM_UPLOAD_MIN_KBPS", 256))  # کمینه سرعت آپلود فرض‌شده برای تایم‌اوت آلبوم (KB/s)
+SC_META_TTL = float(os.environ.get("SC_META_TTL", 3600))             # عمر کش لیست ترک‌های لینک‌های ساندکلود (ثانیه)
+SC_STREAM_TTL = float(os.environ.get("SC_STREAM_TTL", 600))           # عمر کش اطلاعات کامل ترک با لینک استریم (ثانیه)
+SC_META_MAX_ENTRIES = int(os.environ.get("SC_META_MAX_ENTRIES", 2000))  # سقف رکوردهای کش متادیتای ساندکلود
+API_GLOBAL_RATE = float(os.environ.get("API_GLOBAL_RATE", 25))         # سقف درخواست‌های خروجی در ثانیه (کل ربات)
+API_CHAT_RATE = float(os.environ.get("API_CHAT_RATE", 1))              # سقف درخواست در ثانیه برای هر چت
+API_CHAT_BURST = float(os.environ.get("API_CHAT_BURST", 3))            # ظرفیت انفجاری هر چت
+COSMETIC_RESERVE = float(os.environ.get("COSMETIC_RESERVE", 5))        # سهمیه رزرو برای درخواست‌های اصلی نسبت به نوار پیشرفت
+MEMORY_PATH_MAX_MB = float(os.environ.get("MEMORY_PATH_MAX_MB", 20))   # فایل‌های کوچک‌تر از این حجم بدون دیسک پردازش می‌شوند
+MEMORY_BUDGET_MB = float(os.environ.get("MEMORY_BUDGET_MB", 128))      # سقف کل حافظه بافرهای همزمان ورکرها
+YTDL_WORKERS = int(os.environ.get("YTDL_WORKERS", DOWNLOAD_CONCURRENCY))  # تعداد پروسه‌های yt-dlp
+TRANSCODE_ENABLED = os.environ.get("TRANSCODE_ENABLED", "0") == "1"   # تبدیل فایل‌های حجیم پیش از آپلود
+TRANSCODE_FORMAT = os.environ.get("TRANSCODE_FORMAT", "mp3")           # فرمت خروجی: mp3 یا m4a
+TRANSCODE_BITRATE_KBPS = int(os.environ.get("TRANSCODE_BITRATE_KBPS", 320))  # بیت‌ریت خروجی
+TRANSCODE_MIN_MB = float(os.environ.get("TRANSCODE_MIN_MB", 20))       # فایل‌های بزرگ‌تر از این حجم تبدیل می‌شوند
+TRANSCODE_MIN_KBPS = int(os.environ.get("TRANSCODE_MIN_KBPS", 500))    # یا فایل‌هایی با بیت‌ریتی بالاتر از این مقدار
+TRANSCODE_CONCURRENCY = int(os.environ.get("TRANSCODE_CONCURRENCY", os.cpu_count() or 2))  # پروسه‌های همزمان ffmpeg
+TRANSCODE_TIMEOUT = float(os.environ.get("TRANSCODE_TIMEOUT", 600))    # تایم‌اوت هر تبدیل (ثانیه)
+RANGED_MIN_MB = float(os.environ.get("RANGED_MIN_MB", 16))             # فایل‌های بزرگ‌تر از این حجم تکه‌تکه و موازی دانلود می‌شوند
+RANGED_SEGMENT_MB = float(os.environ.get("RANGED_SEGMENT_MB", 4))      # حجم هر تکه دانلود (Range)
+RANGED_PARALLEL = int(os.environ.get("RANGED_PARALLEL", 4))            # تکه‌های همزمان هر فایل
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 16))      # پردازش همزمان آپدیت‌های ورودی
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")             # آدرس عمومی ربات؛ خالی = حالت polling
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")             # مسیر دریافت آپدیت روی وب‌سرور
+# توکن مخفی هدر X-Telegram-Bot-Api-Secret-Token؛ پیش‌فرض از توکن ربات مشتق می‌شود تا همه نسخه‌ها مقدار یکسان داشته باشند
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_MAX_PENDING = int(os.environ.get("WEBHOOK_MAX_PENDING", 1000)) # سقف آپدیت‌های پردازش‌نشده پیش از رد درخواست
+TEMP_ROOT = os.environ.get("TEMP_ROOT", "bot_tmp")                     # پوشه فایل‌های موقت (مثلاً یک tmpfs)
+TEMP_BUDGET_MB = float(os.environ.get("TEMP_BUDGET_MB", 2048))         # سقف فضای موقت رزرو‌شده توسط کارهای همزمان
+TEMP_UNKNOWN_SIZE_MB = float(os.environ.get("TEMP_UNKNOWN_SIZE_MB", 50))  # رزرو پیش‌فرض برای فایل با حجم نامعلوم
+SC_PREVIEW_KBPS = float(os.environ.get("SC_PREVIEW_KBPS", 128))       # بیت‌ریت فرضی ترک‌های ساندکلود در پیش‌نمایش حجم (کیلوبیت)
+TEMP_SWEEP_INTERVAL = float(os.environ.get("TEMP_SWEEP_INTERVAL", 300))   # فاصله جاروی فایل‌های یتیم (ثانیه)
+TEMP_ORPHAN_AGE = float(os.environ.get("TEMP_ORPHAN_AGE", 3600))       # فایل بدون صاحب قدیمی‌تر از این مقدار حذف می‌شود
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") == "1"                 # گرم‌سازی پس‌زمینه ماژول‌ها پس از شروع دریافت آپدیت‌ها
+YTDL_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ytdl_worker.py")
+
+# تنظیمات کاملاً سریع بدون انکود سنگین
+YTDL_OPTS = {
+    'format': 'bestaudio/best',
+    'outtmpl': '%(id)s.%(ext)s',
+    'concurrent_fragment_downloads': 5,
+    'quiet': True,
+    'no_warnings': True,
+    'socket_timeout': 15,
+    'source_address': '0.0.0.0',
+    'hls_prefer_native': True,
+    'hls_use_mpegts': True,  # جلوگیری از مکث انتهایی فایل‌های HLS ساندکلود
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept-Language': 'en-US,en;q=0.9',
+    },
+}
 
 if not BOT_TOKEN:
     logger.critical("❌ BOT_TOKEN در متغیرهای محیطی یافت نشد!")
 
-task_queue = asyncio.Queue()
-download_semaphore = asyncio.Semaphore(2)  # حداکثر ۲ دانلود سنگین همزمان جهت حفظ حافظه RAM
+# اولویت‌ها: عدد کمتر زودتر اجرا می‌شود
+PRIORITY_SINGLE = 0
+PRIORITY_PLAYLIST = 1
 
 # ----------------- وب‌سرور جهت بیدار نگه داشتن ربات -----------------
 async def handle_ping(request):
     return web.Response(text="Bot is live & active!")
 
-async def start_web_server():
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def handle_debug_tasks(request):
+    now = time.time()
+    jobs = [
+        {
+            "task_id": task_id,
+            **job,
+            "elapsed": round(now - job["started"], 2),
+            "stage_elapsed": round(now - job["stage_started"], 2),
+        }
+        for task_id, job in inflight_jobs.items()
+    ]
+    return web.json_response({
+        "queue_depth": task_queue.qsize(),
+        "workers": len(worker_pool.workers),
+        "busy_workers": sorted(worker_pool.busy),
+        "jobs": jobs,
+    }, dumps=functools.partial(json.dumps, ensure_ascii=False))
+
+async def handle_webhook(request):
+    tg_app = request.app["tg_app"]
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        logger.warning(f"⛔ درخواست وبهوک با توکن مخفی نامعتبر از {request.remote} رد شد.")
+        return web.Response(status=403)
+    # پر بودن صف یعنی ورکرهای دریافت عقب افتاده‌اند؛ تلگرام همین آپدیت را بعداً دوباره می‌فرستد
+    if tg_app.update_queue.qsize() >= WEBHOOK_MAX_PENDING:
+        return web.Response(status=503)
+    try:
+        update = Update.de_json(await request.json(), tg_app.bot)
+    except (ValueError, TypeError) as e:
+        logger.warning(f"⚠️ بدنه نامعتبر وبهوک: {e}")
+        return web.Response(status=400)
+    # پاسخ فوری به تلگرام؛ پردازش با سقف UPDATE_CONCURRENCY در خود Application انجام می‌شود
+    await tg_app.update_queue.put(update)
+    return web.Response()
+
+async def start_web_server(tg_app: Application = None):
     app = web.Application()
     app.router.add_get("/", handle_ping)
     app.router.add_get("/ping", handle_ping)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/debug/tasks", handle_debug_tasks)
+    if tg_app is not None and WEBHOOK_URL:
+        app["tg_app"] = tg_app
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.environ.get("PORT", 10000))
@@ -73,99 +263,1654 @@ def format_duration(seconds: int) -> str:
     mins, secs = divmod(int(seconds), 60)
     return f"{mins:02d}:{secs:02d}"
 
+def build_post_keyboard(message_id: int) -> InlineKeyboardMarkup:
+    channel_username = CHANNEL_ID.replace("@", "")
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎧 مشاهده در کانال", url=f"https://t.me/{channel_username}/{message_id}"),
+            InlineKeyboardButton("🗑 حذف از کانال", callback_data=f"del_{message_id}")
+        ]
+    ])
+
+def build_group_keyboard(posts, group_id: int = None) -> InlineKeyboardMarkup:
+    """کیبورد خلاصه آلبوم: لینک و حذف هر پست به همراه دکمه حذف کل گروه"""
+    channel_username = CHANNEL_ID.replace("@", "")
+    rows = [
+        [
+            InlineKeyboardButton(f"🎧 ترک {label}", url=f"https://t.me/{channel_username}/{message_id}"),
+            InlineKeyboardButton(f"🗑 حذف {label}", callback_data=f"del_{message_id}")
+        ]
+        for label, message_id in posts
+    ]
+    if group_id is not None:
+        rows.append([InlineKeyboardButton("🗑 حذف کل آلبوم از کانال", callback_data=f"delg_{group_id}")])
+    return InlineKeyboardMarkup(rows)
+
 def clean_old_temp_files():
-    """پاکسازی فایل‌های باقی‌مانده از اجراهای قبلی"""
-    for item in os.listdir('.'):
-        if item.startswith("sc_downloads_") or item.startswith("temp_"):
+    """پاکسازی فایل‌های باقی‌مانده از اجراهای قبلی (پوشه موقت و فایل‌های قدیمی ریشه پروژه)"""
+    if temp_storage.instance:
+        # در حالت چندنسخه‌ای فقط پوشه همین نسخه و پوشه نسخه‌های از کار افتاده پاک می‌شوند
+        temp_storage.sweep_dead_instances()
+    folders = (temp_storage.root,) if temp_storage.instance else (temp_storage.root, '.')
+    for folder in folders:
+        for item in os.listdir(folder):
+            if item.startswith("sc_downloads_") or item.startswith("temp_"):
+                path = os.path.join(folder, item)
+                try:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                    logger.info(f"🧹 فایل/پوشه قدیمی پاک شد: {path}")
+                except Exception as e:
+                    logger.warning(f"⚠️ خطا در پاکسازی اولیه: {e}")
+
+# ----------------- متریک‌ها (Prometheus) -----------------
+class Metric:
+    def __init__(self, name: str, help_text: str, kind: str):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.values = collections.defaultdict(float)
+
+    @staticmethod
+    def _labels(labels: dict) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def set(self, value: float, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for key, value in self.values.items():
+            yield f"{self.name}{self._labels(dict(key))} {value}"
+
+class Histogram(Metric):
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text, "histogram")
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.setdefault(key, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                series["buckets"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for key, series in self.series.items():
+            labels = dict(key)
+            for bound, count in zip(self.BUCKETS, series["buckets"]):
+                yield f"{self.name}_bucket{self._labels({**labels, 'le': bound})} {count}"
+            yield f"{self.name}_bucket{self._labels({**labels, 'le': '+Inf'})} {series['count']}"
+            yield f"{self.name}_sum{self._labels(labels)} {series['sum']}"
+            yield f"{self.name}_count{self._labels(labels)} {series['count']}"
+
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Latency of each processing stage")
+BYTES_TOTAL = Metric("bot_bytes_total", "Audio bytes downloaded (in) and uploaded (out)", "counter")
+RETRIES_TOTAL = Metric("bot_retries_total", "Failed attempts retried by run_with_retry", "counter")
+FLOOD_TOTAL = Metric("bot_flood_429_total", "Telegram 429 (RetryAfter) responses", "counter")
+TASKS_TOTAL = Metric("bot_tasks_total", "Finished queue tasks by type and result", "counter")
+TRANSCODE_BYTES = Metric("bot_transcode_bytes_total", "Audio bytes before and after the ffmpeg size-optimisation stage", "counter")
+RETRIES_TOTAL.inc(0)
+FLOOD_TOTAL.inc(0)
+
+# وظایف در حال اجرا برای /debug/tasks
+inflight_jobs = {}
+# رهگیری زمانی هر وظیفه در حال اجرا (task_id -> JobTrace)
+job_traces = {}
+
+class JobTrace:
+    """بازه‌های زمانی مراحل یک وظیفه؛ در پایان کار به صورت یک رکورد خلاصه لاگ می‌شود"""
+
+    def __init__(self, task_id: int, task_type: str, worker_id: int, chat_id: int):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.task_id = task_id
+        self.task_type = task_type
+        self.worker_id = worker_id
+        self.chat_id = chat_id
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self.stages = {}
+
+    def add(self, stage: str, start: float, seconds: float, ok: bool):
+        totals = self.stages.setdefault(stage, {"count": 0, "seconds": 0.0, "max": 0.0, "failed": 0})
+        totals["count"] += 1
+        totals["seconds"] += seconds
+        totals["max"] = max(totals["max"], seconds)
+        totals["failed"] += 0 if ok else 1
+        # پلی‌لیست‌های بزرگ صدها بازه دارند؛ جمع هر مرحله کامل می‌ماند و فقط جزئیات محدود می‌شود
+        if len(self.spans) < JOB_TRACE_MAX_SPANS:
+            self.spans.append({"stage": stage, "at": round(start - self.started, 3), "seconds": round(seconds, 3), "ok": ok})
+        else:
+            self.dropped += 1
+
+    def summary(self, error: str = None) -> dict:
+        return {
+            "event": "job_summary",
+            "job_id": self.job_id,
+            "task_id": self.task_id,
+            "type": self.task_type,
+            "worker": self.worker_id,
+            "chat_id": self.chat_id,
+            "result": "failed" if error else "done",
+            "error": error[:300] if error else None,
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "stages": {k: {**v, "seconds": round(v["seconds"], 3), "max": round(v["max"], 3)} for k, v in self.stages.items()},
+            "spans": self.spans,
+            "spans_dropped": self.dropped,
+        }
+
+@contextlib.contextmanager
+def timed_stage(stage: str, task_id: int = None):
+    job = inflight_jobs.get(task_id)
+    if job is not None:
+        job["stage"] = stage
+        job["stage_started"] = time.time()
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = job_traces.get(task_id)
+        if trace is not None:
+            trace.add(stage, start, elapsed, ok)
+
+def temp_disk_usage() -> int:
+    total = 0
+    for entry in os.scandir(temp_storage.root):
+        if not entry.name.startswith(("temp_", "sc_downloads_")):
+            continue
+        paths = [entry.path]
+        if entry.is_dir(follow_symlinks=False):
+            paths = [os.path.join(root, f) for root, _, files in os.walk(entry.path) for f in files]
+        for path in paths:
             try:
-                if os.path.isdir(item):
-                    shutil.rmtree(item)
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+    return total
+
+def render_metrics() -> str:
+    lines = []
+    for metric in (STAGE_SECONDS, BYTES_TOTAL, RETRIES_TOTAL, FLOOD_TOTAL, TASKS_TOTAL, TRANSCODE_BYTES):
+        lines.extend(metric.render())
+
+    limiters = (download_limiter, tag_limiter, upload_limiter, transcode_limiter)
+    snapshot = [
+        ("bot_queue_depth", "Tasks waiting in the durable queue", [({}, task_queue.qsize())]),
+        ("bot_workers", "Queue workers by state", [
+            ({"state": "busy"}, len(worker_pool.busy)),
+            ({"state": "idle"}, len(worker_pool.workers) - len(worker_pool.busy)),
+        ]),
+        ("bot_limiter_in_use", "Slots in use per resource limiter", [({"resource": l.name}, l.in_use) for l in limiters]),
+        ("bot_limiter_waiting", "Waiters per resource limiter", [({"resource": l.name}, l.waiting()) for l in limiters]),
+        ("bot_memory_budget_bytes", "Bytes reserved from the in-memory budget", [({}, memory_budget.used)]),
+        ("bot_temp_disk_bytes", "Bytes used by temp files and download dirs", [({}, temp_disk_usage())]),
+        ("bot_temp_budget_bytes", "Bytes reserved from the temp storage budget", [({}, temp_storage.budget.used)]),
+        ("bot_pending_status_edits", "Coalesced status edits waiting to be sent", [({}, len(outbound_scheduler._pending))]),
+        ("bot_repost_cache", "Repost cache counters", [({"kind": k}, v) for k, v in repost_cache.stats().items()]),
+        ("bot_sc_meta_cache", "SoundCloud metadata cache counters", [({"kind": k}, v) for k, v in sc_meta_cache.stats().items()]),
+        ("bot_startup_seconds", "Import durations and time from process start to each startup phase",
+         [({"phase": k}, v) for k, v in startup_timings.items()]),
+    ]
+    for name, help_text, values in snapshot:
+        gauge = Metric(name, help_text, "gauge")
+        for labels, value in values:
+            gauge.set(value, **labels)
+        lines.extend(gauge.render())
+    return "\n".join(lines) + "\n"
+
+# ----------------- اجرای SQLite خارج از حلقه رویداد -----------------
+class SqliteExecutor:
+    """همه دستورهای یک اتصال SQLite در یک thread اختصاصی اجرا می‌شوند تا انتظار روی قفل دیتابیس مشترک (busy_timeout) حلقه رویداد را متوقف نکند"""
+
+    def __init__(self, db_path: str, name: str):
+        self.name = name
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=name)
+        self.conn = self.call(self._connect, db_path)
+
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def call(self, fn, *args):
+        """اجرای همگام؛ فقط برای راه‌اندازی، پیش از شروع کار حلقه رویداد"""
+        return self._executor.submit(fn, *args).result()
+
+    def run(self, fn, *args) -> asyncio.Future:
+        """دستور همین لحظه به صف thread سپرده می‌شود؛ لغو انتظار روی Future جلوی اجرای آن را نمی‌گیرد"""
+        return asyncio.wrap_future(self._executor.submit(fn, *args))
+
+    def submit(self, fn, *args):
+        """اجرا بدون انتظار برای نتیجه؛ ترتیب نسبت به بقیه دستورهای همین اتصال حفظ می‌شود"""
+        self._executor.submit(fn, *args).add_done_callback(self._log_failure)
+
+    def _log_failure(self, future):
+        if future.exception() is not None:
+            logger.error(f"❌ خطای SQLite در {self.name}: {future.exception()}")
+
+# ----------------- کش بازنشر (Repost Cache) -----------------
+class RepostCache:
+    """کش ماندگار فایل‌های منتشرشده بر اساس شناسه یکتای محتوا (file_unique_id / آیدی ترک ساندکلود)"""
+
+    def __init__(self, db_path: str, max_entries: int, max_age_days: float):
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        # نوشتن‌ها (ثبت، به‌روزرسانی last_used، پاکسازی) در thread اختصاصی انجام می‌شوند تا قفل دیتابیس حلقه رویداد را متوقف نکند؛
+        # خواندن‌ها با اتصال جدا و در حالت WAL بدون انتظار روی نویسنده انجام می‌شوند
+        self._db = SqliteExecutor(db_path, "repost-cache-db")
+        self._db.call(self._create_tables)
+        self._db.call(self._evict)
+        self._read_conn = sqlite3.connect(db_path)
+
+    def _create_tables(self):
+        conn = self._db.conn
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS repost_cache ("
+            " cache_key TEXT PRIMARY KEY,"
+            " file_id TEXT NOT NULL,"
+            " message_id INTEGER,"
+            " title TEXT,"
+            " duration INTEGER,"
+            " file_size INTEGER,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_repost_cache_msg ON repost_cache(message_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_repost_cache_used ON repost_cache(last_used)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS post_groups ("
+            " group_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " message_ids TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str):
+        now = time.time()
+        row = self._read_conn.execute(
+            "SELECT file_id, message_id, title, duration, file_size, created_at FROM repost_cache WHERE cache_key = ?",
+            (key,)
+        ).fetchone()
+        if row is None or now - row[5] > self.max_age:
+            if row is not None:
+                self._db.submit(self._execute, "DELETE FROM repost_cache WHERE cache_key = ?", (key,))
+            self.misses += 1
+            return None
+        self._db.submit(self._execute, "UPDATE repost_cache SET last_used = ? WHERE cache_key = ?", (now, key))
+        self.hits += 1
+        return {"file_id": row[0], "message_id": row[1], "title": row[2], "duration": row[3] or 0, "file_size": row[4] or 0}
+
+    def put(self, keys, file_id: str, message_id: int, title: str, duration: int, file_size: int):
+        now = time.time()
+        rows = [(k, file_id, message_id, title, int(duration or 0), int(file_size or 0), now, now) for k in keys if k]
+        self._db.submit(self._put, rows)
+
+    def forget_message(self, message_id: int):
+        """پست حذف‌شده دیگر لینک معتبری ندارد؛ file_id برای بازنشر بدون آپلود باقی می‌ماند"""
+        self._db.submit(self._execute, "UPDATE repost_cache SET message_id = NULL WHERE message_id = ?", (message_id,))
+
+    async def add_group(self, message_ids) -> int:
+        """پیام‌های یک آلبوم کانال برای حذف یکجا ذخیره می‌شوند"""
+        cur = await self._db.run(
+            self._execute, "INSERT INTO post_groups (message_ids, created_at) VALUES (?, ?)",
+            (json.dumps(list(message_ids)), time.time())
+        )
+        return cur.lastrowid
+
+    def get_group(self, group_id: int):
+        row = self._read_conn.execute("SELECT message_ids FROM post_groups WHERE group_id = ?", (group_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def forget_group(self, group_id: int):
+        self._db.submit(self._execute, "DELETE FROM post_groups WHERE group_id = ?", (group_id,))
+
+    def stats(self) -> dict:
+        size = self._read_conn.execute("SELECT COUNT(*) FROM repost_cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": size}
+
+    def _execute(self, sql: str, params=()):
+        return self._db.conn.execute(sql, params)
+
+    def _put(self, rows):
+        self._db.conn.executemany("INSERT OR REPLACE INTO repost_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._evict()
+
+    def _evict(self):
+        conn = self._db.conn
+        conn.execute("DELETE FROM repost_cache WHERE created_at < ?", (time.time() - self.max_age,))
+        conn.execute("DELETE FROM post_groups WHERE created_at < ?", (time.time() - self.max_age,))
+        conn.execute(
+            "DELETE FROM repost_cache WHERE cache_key IN ("
+            " SELECT cache_key FROM repost_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+repost_cache = RepostCache(STATE_DB_PATH, CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS)
+
+class MetadataCache:
+    """کش درون‌حافظه LRU با عمر محدود برای نتایج استخراج yt-dlp (لیست ترک‌های لینک و اطلاعات کامل هر ترک)"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key: str):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: str, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def discard(self, key: str):
+        self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._data)}
+
+sc_meta_cache = MetadataCache(SC_META_MAX_ENTRIES, SC_META_TTL)
+
+async def repost_from_cache(app, cache_key: str, cached: dict, caption: str) -> int:
+    """لینک پست موجود را برمی‌گرداند یا با file_id ذخیره‌شده (بدون آپلود مجدد) دوباره منتشر می‌کند"""
+    if cached["message_id"]:
+        return cached["message_id"]
+
+    sent_msg = None
+    async def resend_task():
+        nonlocal sent_msg
+        await outbound_scheduler.acquire(CHANNEL_ID)
+        sent_msg = await app.bot.send_audio(
+            chat_id=CHANNEL_ID,
+            audio=cached["file_id"],
+            caption=caption,
+            title=cached["title"],
+            performer=CHANNEL_ID,
+            duration=cached["duration"],
+            parse_mode="Markdown"
+        )
+
+    await run_with_retry(resend_task, max_retries=3)
+    repost_cache.put([cache_key], cached["file_id"], sent_msg.message_id, cached["title"], cached["duration"], cached["file_size"])
+    return sent_msg.message_id
+
+# ----------------- سهمیه حافظه (Byte Budget) -----------------
+class ByteBudget:
+    """سهمیه بایت مشترک بین ورکرها برای جلوگیری از پر شدن حافظه یا دیسک توسط کارهای همزمان"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    def try_reserve(self, nbytes: int) -> bool:
+        if self.used + nbytes > self.limit:
+            return False
+        self.used += nbytes
+        return True
+
+    async def reserve(self, nbytes: int):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + nbytes <= self.limit)
+            self.used += nbytes
+
+    async def release(self, nbytes: int):
+        async with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    async def wait_for_room(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used < self.limit)
+
+memory_budget = ByteBudget(int(MEMORY_BUDGET_MB * 1024 * 1024))
+
+# ----------------- مدیریت فضای موقت (Temp Storage) -----------------
+class TempStorage:
+    """پوشه فایل‌های موقت با سهمیه بایت؛ کارها پیش از دانلود فضای لازم را رزرو می‌کنند و فایل‌های یتیم دوره‌ای جارو می‌شوند"""
+
+    def __init__(self, root: str, budget: int, instance: str = None):
+        # در حالت چندنسخه‌ای هر نسخه زیرپوشه خودش را دارد تا پاکسازی یک نسخه به دانلودهای بقیه دست نزند
+        self.base = os.path.abspath(root)
+        self.instance = self.dir_name(instance) if instance else None
+        self.root = os.path.join(self.base, self.instance) if instance else self.base
+        self.budget = ByteBudget(budget)
+        self._active = set()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def clamp(self, nbytes: int) -> int:
+        # فایلی بزرگ‌تر از کل سهمیه، به تنهایی کل سهمیه را می‌گیرد تا برای همیشه منتظر نماند
+        return max(0, min(int(nbytes), self.budget.limit))
+
+    def claim(self, prefix: str):
+        """فایل‌ها و پوشه‌هایی که با این پیشوند شروع می‌شوند تا unclaim از جارو در امان هستند"""
+        self._active.add(prefix)
+
+    def unclaim(self, prefix: str):
+        self._active.discard(prefix)
+
+    def sweep(self):
+        now = time.time()
+        active = tuple(self._active)
+        for entry in os.scandir(self.root):
+            if active and entry.name.startswith(active):
+                continue
+            try:
+                if now - entry.stat(follow_symlinks=False).st_mtime < TEMP_ORPHAN_AGE:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
                 else:
-                    os.remove(item)
-                logger.info(f"🧹 فایل/پوشه قدیمی پاک شد: {item}")
-            except Exception as e:
-                logger.warning(f"⚠️ خطا در پاکسازی اولیه: {e}")
+                    os.remove(entry.path)
+                logger.info(f"🧹 فایل موقت یتیم پاک شد: {entry.name}")
+            except OSError as e:
+                logger.warning(f"⚠️ خطا در جاروی فایل موقت {entry.name}: {e}")
+        if self.instance:
+            self.sweep_dead_instances()
+
+    @staticmethod
+    def dir_name(instance: str) -> str:
+        return "".join(c if c.isalnum() or c in "-_." else "_" for c in instance)
+
+    def sweep_dead_instances(self):
+        """حذف زیرپوشه نسخه‌هایی که در مدت LEASE_TTL هیچ heartbeat نفرستاده‌اند"""
+        try:
+            live = {self.dir_name(i) for i in coordinator.live_instances()}
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ فهرست نسخه‌های زنده خوانده نشد؛ پاکسازی پوشه نسخه‌ها به دور بعد موکول شد: {e}")
+            return
+        now = time.time()
+        for entry in os.scandir(self.base):
+            if entry.name == self.instance or entry.name in live:
+                continue
+            try:
+                # پوشه نسخه‌ای که همین حالا بالا آمده و هنوز ثبت نشده، دست نمی‌خورد
+                if now - entry.stat(follow_symlinks=False).st_mtime < LEASE_TTL:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+                logger.info(f"🧹 فایل‌های موقت نسخه از کار افتاده پاک شد: {entry.name}")
+            except OSError as e:
+                logger.warning(f"⚠️ خطا در پاکسازی پوشه نسخه {entry.name}: {e}")
+
+    async def sweep_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.sweep)
+
+temp_storage = TempStorage(TEMP_ROOT, int(TEMP_BUDGET_MB * 1024 * 1024), INSTANCE_ID if COORDINATION == "sqlite" else None)
 
 # ----------------- ویرایش متادیتا -----------------
-def edit_metadata(file_path: str, title: str):
+TAG_MAX_PADDING = 256 * 1024  # حداکثر فضای خالی مجاز در بلوک تگ قبل از بازنویسی کامل فایل
+
+def load_mutagen():
+    """import تنبل mutagen؛ هر محل استفاده اول این را صدا می‌زند تا زمان واقعی import در گزارش راه‌اندازی ثبت شود"""
+    with timed_import("mutagen"):
+        import mutagen.id3
+        import mutagen.flac
+        import mutagen.mp4
+
+class CoverArtCache:
+    """کاور یک بار خوانده و برای هر فرمت از پیش ساخته می‌شود؛ فقط با تغییر mtime فایل دوباره بارگذاری می‌شود"""
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._frames = None
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if mtime != self._mtime:
+                load_mutagen()
+                from mutagen.id3 import APIC
+                from mutagen.flac import Picture
+                from mutagen.mp4 import MP4Cover
+                with open(self.path, 'rb') as f:
+                    cover_data = f.read()
+                picture = Picture()
+                picture.type = 3
+                picture.mime = 'image/jpeg'
+                picture.data = cover_data
+                self._frames = types.SimpleNamespace(
+                    apic=APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover_data),
+                    flac=picture,
+                    mp4=MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG),
+                )
+                self._mtime = mtime
+                logger.info(f"🖼 کاور از {self.path} بارگذاری شد ({format_size(len(cover_data))}).")
+            return self._frames
+
+cover_art = CoverArtCache(COVER_PATH)
+
+def _tag_padding(info):
+    # اگر تگ جدید در فضای خالی فعلی جا شود، فقط همان بلوک بازنویسی می‌شود و صوت دست نمی‌خورد
+    if 0 <= info.padding <= TAG_MAX_PADDING:
+        return info.padding
+    return info.get_default_padding()
+
+def edit_metadata(file_path: str, title: str, fileobj=None):
+    """در صورت ارسال fileobj (بافر حافظه)، تگ‌ها مستقیماً روی همان بافر نوشته می‌شوند و file_path فقط برای تشخیص فرمت است"""
+    load_mutagen()
+    from mutagen.id3 import ID3, TPE1, TIT2, TALB, COMM, ID3NoHeaderError
+    from mutagen.flac import FLAC
+    from mutagen.mp4 import MP4
+
     ext = os.path.splitext(file_path)[1].lower()
-    cover_absolute_path = os.path.abspath(COVER_PATH)
+    frames = cover_art.get()
 
-    if not os.path.exists(cover_absolute_path):
-        logger.error(f"❌ فایل کاور در مسیر {cover_absolute_path} یافت نشد!")
+    def target():
+        # mutagen روی بافر از موقعیت فعلی می‌خواند؛ پیش از هر بارگذاری/ذخیره به ابتدا برگردانده می‌شود
+        if fileobj is None:
+            return file_path
+        fileobj.seek(0)
+        return fileobj
+
+    if frames is None:
+        logger.error(f"❌ فایل کاور در مسیر {cover_art.path} یافت نشد!")
         return False
 
     try:
-        with open(cover_absolute_path, 'rb') as f:
-            cover_data = f.read()
-
         if ext == '.mp3':
             try:
-                tags = ID3(file_path)
-                tags.delete(file_path)
-                tags = ID3()
+                tags = ID3(target())
             except ID3NoHeaderError:
                 tags = ID3()
+            tags.clear()
 
-            tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover_data))
+            tags.add(frames.apic)
             tags.add(TIT2(encoding=3, text=f"{title} {CHANNEL_ID}"))
             tags.add(TPE1(encoding=3, text=CHANNEL_ID))
             tags.add(TALB(encoding=3, text=CHANNEL_ID))
             tags.add(COMM(encoding=3, lang='eng', desc='Comment', text=CHANNEL_ID))
-            tags.save(file_path, v2_version=3)
+            tags.save(target(), v1=0, v2_version=3, padding=_tag_padding)
 
         elif ext == '.flac':
-            audio = FLAC(file_path)
+            audio = FLAC(target())
             audio.clear()
-            image = Picture()
-            image.type = 3
-            image.mime = 'image/jpeg'
-            image.data = cover_data
-            audio.add_picture(image)
+            audio.clear_pictures()
+            audio.add_picture(frames.flac)
             audio['title'] = f"{title} {CHANNEL_ID}"
             audio['artist'] = CHANNEL_ID
             audio['album'] = CHANNEL_ID
             audio['comment'] = CHANNEL_ID
-            audio.save()
+            audio.save(target(), padding=_tag_padding)
 
         elif ext in ['.m4a', '.mp4']:
-            audio = MP4(file_path)
-            audio.delete()
-            audio['covr'] = [MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)]
+            audio = MP4(target())
+            if audio.tags is None:
+                audio.add_tags()
+            audio.tags.clear()
+            audio['covr'] = [frames.mp4]
             audio['\xa9nam'] = f"{title} {CHANNEL_ID}"
             audio['\xa9ART'] = CHANNEL_ID
             audio['\xa9alb'] = CHANNEL_ID
             audio['\xa9cmt'] = CHANNEL_ID
-            audio.save()
+            audio.save(target(), padding=_tag_padding)
 
         return True
     except Exception as e:
         logger.error(f"❌ خطا در ویرایش متادیتا: {e}", exc_info=True)
         return False
 
+# ----------------- بهینه‌سازی حجم با ffmpeg -----------------
+TRANSCODE_TARGETS = {
+    "mp3": (".mp3", ["-c:a", "libmp3lame"]),
+    "m4a": (".m4a", ["-c:a", "aac", "-movflags", "+faststart"]),
+}
+LOSSY_EXTS = ('.mp3', '.m4a', '.mp4', '.aac', '.ogg', '.opus')
+
+def should_transcode(ext: str, file_size: int, duration: int) -> bool:
+    """فقط فایل‌های حجیم یا پربیت‌ریت تبدیل می‌شوند؛ فایلی که از خروجی هدف کم‌حجم‌تر است دست نمی‌خورد"""
+    if not TRANSCODE_ENABLED or not file_size:
+        return False
+    kbps = file_size * 8 / 1000 / duration if duration else None
+    if kbps is not None and kbps <= TRANSCODE_BITRATE_KBPS * 1.1:
+        return False
+    if kbps is None and ext.lower() in LOSSY_EXTS:
+        # بدون مدت زمان، بیت‌ریت فایل فشرده معلوم نیست و تبدیل ممکن است سودی نداشته باشد
+        return False
+    return file_size >= TRANSCODE_MIN_MB * 1024 * 1024 or (kbps or 0) >= TRANSCODE_MIN_KBPS
+
+_ffmpeg_ready = None
+
+def _bootstrap_ffmpeg() -> bool:
+    started = time.perf_counter()
+    try:
+        with timed_import("static_ffmpeg"):
+            import static_ffmpeg
+        # در کانتینر تازه ممکن است باینری‌ها دانلود و از حالت فشرده خارج شوند
+        static_ffmpeg.add_paths()
+    except Exception as e:
+        logger.error(f"❌ آماده‌سازی ffmpeg ناموفق بود: {e}")
+    startup_timings.setdefault("ffmpeg_bootstrap", time.perf_counter() - started)
+    return shutil.which("ffmpeg") is not None
+
+def ensure_ffmpeg() -> asyncio.Future:
+    """ffmpeg در اولین نیاز یا در گرم‌سازی پس‌زمینه، در یک ترد جدا و فقط یک بار آماده می‌شود"""
+    global _ffmpeg_ready
+    if _ffmpeg_ready is None:
+        _ffmpeg_ready = asyncio.ensure_future(asyncio.to_thread(_bootstrap_ffmpeg))
+    return _ffmpeg_ready
+
+async def transcode_audio(src_path: str) -> str:
+    """تبدیل فایل با ffmpeg؛ خروجی مستقیماً روی دیسک نوشته می‌شود و مسیر فایل جدید برگردانده می‌شود"""
+    out_ext, codec_args = TRANSCODE_TARGETS[TRANSCODE_FORMAT]
+    dst_path = os.path.splitext(src_path)[0] + ".transcoded" + out_ext
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-v", "error", "-nostdin", "-y",
+        "-i", src_path, "-vn", "-map_metadata", "-1",
+        *codec_args, "-b:a", f"{TRANSCODE_BITRATE_KBPS}k", dst_path,
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=TRANSCODE_TIMEOUT)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        raise
+    if proc.returncode != 0:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        raise Exception(f"ffmpeg با کد {proc.returncode} متوقف شد: {stderr.decode(errors='replace')[-300:]}")
+    return dst_path
+
+# ----------------- هماهنگی بین نسخه‌ها (Multi-Instance Coordination) -----------------
+class LocalCoordinator:
+    """حالت تک‌نسخه‌ای: همه محدودیت‌ها داخل همین پروسه اعمال می‌شوند"""
+
+    shared = False
+
+    async def acquire_slot(self, resource: str, capacity: int):
+        return None
+
+    def release_slot(self, resource: str, slot: int):
+        pass
+
+    async def take_tokens(self, buckets) -> float:
+        return 0.0
+
+    def pause(self, seconds: float):
+        pass
+
+    async def heartbeat(self):
+        pass
+
+    def live_instances(self):
+        return set()
+
+class SqliteCoordinator:
+    """هماهنگی چند نسخه ربات روی یک فایل SQLite مشترک: اسلات‌های همزمانی سراسری با اجاره زمان‌دار، سطل‌های نرخ و توقف Flood مشترک"""
+
+    shared = True
+
+    def __init__(self, db_path: str, instance_id: str, lease_ttl: float):
+        self.instance_id = instance_id
+        self.lease_ttl = lease_ttl
+        self._db = SqliteExecutor(db_path, "coordinator-db")
+        self._conn = self._db.conn
+        self._db.call(self._create_tables)
+
+    def _create_tables(self):
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS global_slots ("
+            " resource TEXT NOT NULL,"
+            " slot INTEGER NOT NULL,"
+            " owner TEXT NOT NULL,"
+            " lease_until REAL NOT NULL,"
+            " PRIMARY KEY (resource, slot))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            " name TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " paused_until REAL NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS instances ("
+            " instance_id TEXT PRIMARY KEY,"
+            " last_seen REAL NOT NULL)"
+        )
+        self._heartbeat()
+
+    def _try_acquire_slot(self, resource: str, capacity: int):
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            # اسلات نسخه‌ای که heartbeat نفرستاده (از کار افتاده) آزاد می‌شود
+            self._conn.execute("DELETE FROM global_slots WHERE resource = ? AND lease_until < ?", (resource, now))
+            used = {row[0] for row in self._conn.execute("SELECT slot FROM global_slots WHERE resource = ?", (resource,))}
+            slot = next((i for i in range(capacity) if i not in used), None)
+            if slot is not None:
+                self._conn.execute(
+                    "INSERT INTO global_slots VALUES (?, ?, ?, ?)",
+                    (resource, slot, self.instance_id, now + self.lease_ttl)
+                )
+        return slot
+
+    async def acquire_slot(self, resource: str, capacity: int):
+        delay = 0.05
+        while True:
+            pending = self._db.run(self._try_acquire_slot, resource, capacity)
+            try:
+                slot = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # اسلاتی که پس از لغو در thread گرفته شود، بلافاصله آزاد می‌شود تا با heartbeat برای همیشه نماند
+                pending.add_done_callback(
+                    lambda f: f.cancelled() or f.exception() or f.result() is None or self.release_slot(resource, f.result())
+                )
+                raise
+            if slot is not None:
+                return slot
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def release_slot(self, resource: str, slot: int):
+        self._db.submit(self._release_slot, resource, slot)
+
+    def _release_slot(self, resource: str, slot: int):
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM global_slots WHERE resource = ? AND slot = ? AND owner = ?",
+                (resource, slot, self.instance_id)
+            )
+
+    async def take_tokens(self, buckets) -> float:
+        """از همه سطل‌های مشترک ([(نام، نرخ، ظرفیت)]) در یک تراکنش توکن برمی‌دارد؛ خروجی صفر یعنی موفق و در غیر این صورت زمان انتظار (ثانیه)"""
+        return await self._db.run(self._take_tokens, buckets)
+
+    def _take_tokens(self, buckets) -> float:
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            pause = self._paused_until() - now
+            if pause > 0:
+                return pause
+            rows, wait = [], 0.0
+            for name, rate, capacity in buckets:
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at, paused_until FROM rate_buckets WHERE name = ?", (name,)
+                ).fetchone()
+                tokens, updated, paused_until = row if row else (capacity, now, 0.0)
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                rows.append((name, tokens, paused_until))
+            # توکن فقط وقتی برداشته می‌شود که همه سطل‌ها اجازه دهند
+            if not wait:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO rate_buckets VALUES (?, ?, ?, ?)",
+                    [(name, tokens - 1, now, paused_until) for name, tokens, paused_until in rows]
+                )
+        return wait
+
+    def _paused_until(self) -> float:
+        row = self._conn.execute("SELECT paused_until FROM rate_buckets WHERE name = 'flood'").fetchone()
+        return row[0] if row else 0.0
+
+    def pause(self, seconds: float):
+        """خطای 429 در یک نسخه، ارسال همه نسخه‌ها را متوقف می‌کند"""
+        self._db.submit(self._pause, time.time() + seconds)
+
+    def _pause(self, until: float):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO rate_buckets VALUES ('flood', 0, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)",
+                (time.time(), until)
+            )
+
+    async def heartbeat(self):
+        await self._db.run(self._heartbeat)
+
+    def _heartbeat(self):
+        now = time.time()
+        with self._conn:
+            self._conn.execute(
+                "UPDATE global_slots SET lease_until = ? WHERE owner = ?",
+                (now + self.lease_ttl, self.instance_id)
+            )
+            self._conn.execute("INSERT OR REPLACE INTO instances VALUES (?, ?)", (self.instance_id, now))
+            self._conn.execute("DELETE FROM instances WHERE last_seen < ?", (now - 7 * 86400,))
+
+    def live_instances(self):
+        """نسخه‌هایی که در مدت LEASE_TTL اخیر heartbeat فرستاده‌اند"""
+        return self._db.call(self._live_instances)
+
+    def _live_instances(self):
+        rows = self._conn.execute("SELECT instance_id FROM instances WHERE last_seen >= ?", (time.time() - self.lease_ttl,))
+        return {row[0] for row in rows}
+
+coordinator = SqliteCoordinator(STATE_DB_PATH, INSTANCE_ID, LEASE_TTL) if COORDINATION == "sqlite" else LocalCoordinator()
+
+# ----------------- زمان‌بند درخواست‌های خروجی (Flood Control) -----------------
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, reserve: float = 0.0) -> bool:
+        self._refill()
+        if self.tokens - 1 >= reserve:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def wait_time(self, reserve: float = 0.0) -> float:
+        self._refill()
+        return max(0.0, (1 + reserve - self.tokens) / self.rate)
+
+class OutboundScheduler:
+    """زمان‌بند مرکزی درخواست‌های خروجی تلگرام؛ ویرایش‌های وضعیت ادغام می‌شوند و درخواست‌های اصلی اولویت دارند"""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, cosmetic_reserve: float):
+        self.global_rate = global_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.cosmetic_reserve = cosmetic_reserve
+        self.flood_hits = 0
+        self._chat_buckets = {}
+        self._pending = collections.OrderedDict()   # (chat_id, message_id) -> آخرین متن درخواستی
+        self._last_sent = collections.OrderedDict() # (chat_id, message_id) -> متن ارسال‌شده قبلی
+        self._paused_until = 0.0
+        self._priority_waiters = 0
+        self._inflight = set()                      # پیام‌هایی که ویرایششان در حال ارسال است
+        self._send_tasks = set()                    # ارجاع به taskهای ارسال تا پیش از پایان جمع‌آوری نشوند
+        self._wakeup = asyncio.Event()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def edit_status(self, text: str, chat_id, message_id, reply_markup=None, parse_mode="Markdown"):
+        """فقط آخرین متن هر پیام نگه داشته می‌شود؛ متن تکراری اصلاً ارسال نمی‌شود"""
+        key = (chat_id, message_id)
+        # با ویرایش در جریان، _last_sent هنوز متن قبلی است و مقایسه با آن معتبر نیست
+        if key not in self._pending and key not in self._inflight and self._last_sent.get(key) == (text, reply_markup):
+            return
+        self._pending[key] = (text, reply_markup, parse_mode)
+        self._wakeup.set()
+
+    def note_retry_after(self, retry_after: float):
+        self.flood_hits += 1
+        FLOOD_TOTAL.inc()
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        coordinator.pause(retry_after)
+        logger.warning(f"🚦 محدودیت Flood تلگرام: توقف ارسال‌ها به مدت {retry_after} ثانیه")
+
+    async def _take_shared(self, chat_id) -> float:
+        """سهمیه مشترک بین نسخه‌ها (در حالت تک‌نسخه‌ای همیشه صفر)"""
+        buckets = [("api", self.global_rate, self.global_rate)]
+        if chat_id is not None:
+            buckets.append((f"chat:{chat_id}", self.chat_rate, self.chat_burst))
+        try:
+            return await coordinator.take_tokens(buckets)
+        except sqlite3.Error as e:
+            # قفل یا خطای گذرای دیتابیس مشترک نباید حلقه زمان‌بند را از کار بیندازد؛ کمی بعد دوباره تلاش می‌شود
+            logger.warning(f"⚠️ خطای SQLite در سهمیه مشترک، تلاش مجدد پس از {QUEUE_POLL_INTERVAL} ثانیه: {e}")
+            return QUEUE_POLL_INTERVAL
+
+    async def acquire(self, chat_id=None):
+        """سهمیه نرخ برای درخواست‌های اصلی (آپلود، حذف، ارسال پیام) که بر ویرایش‌های نمایشی مقدم‌اند"""
+        self._priority_waiters += 1
+        try:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                if self.global_bucket.try_take():
+                    if chat_id is None or self._chat_bucket(chat_id).try_take():
+                        wait = await self._take_shared(chat_id)
+                        if not wait:
+                            return
+                        self.global_bucket.refund()
+                        if chat_id is not None:
+                            self._chat_bucket(chat_id).refund()
+                        await asyncio.sleep(wait)
+                        continue
+                    self.global_bucket.refund()
+                    await asyncio.sleep(self._chat_bucket(chat_id).wait_time())
+                else:
+                    await asyncio.sleep(self.global_bucket.wait_time())
+        finally:
+            self._priority_waiters -= 1
+
+    async def run(self, bot):
+        while True:
+            # برای هر پیام فقط یک ویرایش در جریان است تا ویرایش قدیمی‌تر پس از جدیدتر نرسد
+            sendable = [k for k in self._pending if k not in self._inflight]
+            if not sendable:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            # ویرایش‌های نمایشی فقط از سهمیه اضافه استفاده می‌کنند و منتظر درخواست‌های اصلی می‌مانند
+            if self._priority_waiters or not self.global_bucket.try_take(self.cosmetic_reserve):
+                await asyncio.sleep(max(0.05, self.global_bucket.wait_time(self.cosmetic_reserve)))
+                continue
+
+            ready_key = next((k for k in sendable if self._chat_bucket(k[0]).try_take()), None)
+            if ready_key is None:
+                self.global_bucket.refund()
+                await asyncio.sleep(min(self._chat_bucket(k[0]).wait_time() for k in sendable))
+                continue
+
+            wait = await self._take_shared(ready_key[0])
+            if wait:
+                self.global_bucket.refund()
+                self._chat_bucket(ready_key[0]).refund()
+                await asyncio.sleep(wait)
+                continue
+
+            text, reply_markup, parse_mode = self._pending.pop(ready_key)
+            self._inflight.add(ready_key)
+            task = asyncio.create_task(self._send(bot, ready_key, text, reply_markup, parse_mode))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+
+    async def _send(self, bot, key, text, reply_markup, parse_mode):
+        try:
+            await self._edit(bot, key, text, reply_markup, parse_mode)
+        finally:
+            self._inflight.discard(key)
+            # متن جدیدتری که در این فاصله رسیده، حالا قابل ارسال است
+            if key in self._pending:
+                self._wakeup.set()
+
+    async def _edit(self, bot, key, text, reply_markup, parse_mode):
+        chat_id, message_id = key
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup, parse_mode=parse_mode)
+        except RetryAfter as e:
+            self.note_retry_after(e.retry_after)
+            # اگر متن جدیدتری در این فاصله رسیده باشد، همان جایگزین این ویرایش می‌شود
+            if key not in self._pending:
+                self._pending[key] = (text, reply_markup, parse_mode)
+            return
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.debug(f"ویرایش پیام وضعیت {key} انجام نشد: {e}")
+        except Exception as e:
+            logger.debug(f"ویرایش پیام وضعیت {key} انجام نشد: {e}")
+            return
+
+        self._last_sent[key] = (text, reply_markup)
+        self._last_sent.move_to_end(key)
+        while len(self._last_sent) > 10000:
+            self._last_sent.popitem(last=False)
+
+outbound_scheduler = OutboundScheduler(API_GLOBAL_RATE, API_CHAT_RATE, API_CHAT_BURST, COSMETIC_RESERVE)
+
+# ----------------- محدودکننده منصفانه منابع (Fair Scheduler) -----------------
+class FairLimiter:
+    """محدودکننده منابع با نوبت‌دهی چرخشی بین چت‌ها و اولویت فایل‌های تکی بر ترک‌های پلی‌لیست"""
+
+    def __init__(self, name: str, capacity: int, global_capacity: int = 0):
+        self.name = name
+        self.capacity = capacity
+        self.global_capacity = global_capacity  # سقف مشترک بین همه نسخه‌ها (0 = فقط سقف محلی)
+        self.in_use = 0
+        self._waiters = {}  # priority -> OrderedDict(chat_id -> deque[Future])
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id, priority: int = PRIORITY_SINGLE):
+        await self.acquire(chat_id, priority)
+        try:
+            global_slot = await coordinator.acquire_slot(self.name, self.global_capacity) if self.global_capacity else None
+            try:
+                yield
+            finally:
+                if global_slot is not None:
+                    coordinator.release_slot(self.name, global_slot)
+        finally:
+            self.release()
+
+    async def acquire(self, chat_id, priority: int = PRIORITY_SINGLE):
+        fut = asyncio.get_running_loop().create_future()
+        chats = self._waiters.setdefault(priority, collections.OrderedDict())
+        chats.setdefault(chat_id, collections.deque()).append(fut)
+        self._wake()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._wake()
+
+    def resize(self, capacity: int):
+        self.capacity = capacity
+        self._wake()
+
+    def waiting(self) -> int:
+        return sum(len(q) for chats in self._waiters.values() for q in chats.values())
+
+    def _wake(self):
+        while self.in_use < self.capacity:
+            fut = self._next_waiter()
+            if fut is None:
+                break
+            self.in_use += 1
+            fut.set_result(None)
+
+    def _next_waiter(self):
+        for priority in sorted(self._waiters):
+            chats = self._waiters[priority]
+            while chats:
+                # چتی که نوبت گرفت به انتهای صف چرخشی منتقل می‌شود
+                chat_id, queue = chats.popitem(last=False)
+                fut = queue.popleft()
+                if queue:
+                    chats[chat_id] = queue
+                if not fut.cancelled():
+                    return fut
+            del self._waiters[priority]
+        return None
+
+download_limiter = FairLimiter("download", DOWNLOAD_CONCURRENCY, GLOBAL_DOWNLOAD_CONCURRENCY)
+tag_limiter = FairLimiter("tag", TAG_CONCURRENCY)
+upload_limiter = FairLimiter("upload", UPLOAD_CONCURRENCY, GLOBAL_UPLOAD_CONCURRENCY)
+transcode_limiter = FairLimiter("transcode", TRANSCODE_CONCURRENCY)
+
+# ----------------- استخر پروسه‌های yt-dlp -----------------
+class YtdlWorkerPool:
+    """استخر پروسه‌های yt-dlp؛ هر کار در صورت تایم‌اوت یا لغو واقعاً kill می‌شود و پیشرفت از طریق pipe برمی‌گردد"""
+
+    def __init__(self, size: int, opts: dict):
+        self.size = size
+        self.opts = opts
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+        self.procs = set()  # همه پروسه‌های زنده، چه بیکار و چه در حال کار
+
+    async def _spawn(self):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, YTDL_WORKER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            limit=32 * 1024 * 1024
+        )
+        proc.stdin.write((json.dumps({"opts": self.opts}) + "\n").encode())
+        self.procs.add(proc)
+        logger.info(f"🧩 پروسه yt-dlp جدید اجرا شد (PID {proc.pid})")
+        return proc
+
+    async def run(self, job: dict, timeout: float, on_progress=None):
+        async with self._slots:
+            proc = self._idle.pop() if self._idle else await self._spawn()
+            try:
+                proc.stdin.write((json.dumps(job) + "\n").encode())
+                await proc.stdin.drain()
+                message = await asyncio.wait_for(self._read_result(proc, on_progress), timeout)
+            except BaseException:
+                # تایم‌اوت، لغو یا خطای پروسه: دانلود نیمه‌کاره همراه پروسه از بین می‌رود
+                self.procs.discard(proc)
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                    logger.warning(f"🔪 پروسه yt-dlp (PID {proc.pid}) متوقف شد.")
+                raise
+            # خطای خود کار (مثلاً DRM) پروسه را خراب نمی‌کند و پروسه برای کار بعدی آماده می‌ماند
+            self._idle.append(proc)
+            if message["type"] == "error":
+                raise Exception(message["message"])
+            return message["data"]
+
+    async def warm(self):
+        """یک پروسه از قبل اجرا می‌شود تا اولین لینک منتظر import شدن yt-dlp نماند"""
+        if not self._idle and not self._slots.locked():
+            self._idle.append(await self._spawn())
+
+    async def close(self):
+        while self._idle:
+            proc = self._idle.pop()
+            self.procs.discard(proc)
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+    async def _read_result(self, proc, on_progress):
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                raise Exception("پروسه yt-dlp به طور غیرمنتظره بسته شد.")
+            message = json.loads(line)
+            if message["type"] != "progress":
+                return message
+            if on_progress:
+                on_progress(message["downloaded"], message["total"])
+
+ytdl_pool = YtdlWorkerPool(YTDL_WORKERS, YTDL_OPTS)
+
+# ----------------- دانلود موازی و ازسرگیری‌پذیر فایل‌های تلگرام -----------------
+class RangeNotSupported(Exception):
+    pass
+
+class RangedDownload:
+    """دانلود یک فایل با درخواست‌های Range موازی؛ تکه‌های کامل‌شده در تلاش بعدی دوباره دریافت نمی‌شوند"""
+
+    CHUNK = 256 * 1024
+    _session = None
+
+    def __init__(self, url: str, path: str, size: int, segment_size: int, parallel: int, on_progress=None):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.parallel = parallel
+        self.on_progress = on_progress
+        self.segments = [(start, min(start + segment_size, size)) for start in range(0, size, segment_size)]
+        self.done = set()
+        self.received = 0
+
+    @classmethod
+    def session(cls) -> aiohttp.ClientSession:
+        if cls._session is None or cls._session.closed:
+            cls._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=30))
+        return cls._session
+
+    @classmethod
+    async def close(cls):
+        if cls._session is not None:
+            await cls._session.close()
+
+    async def _fetch_segment(self, index: int, semaphore: asyncio.Semaphore):
+        start, end = self.segments[index]
+        async with semaphore:
+            headers = {"Range": f"bytes={start}-{end - 1}"}
+            async with self.session().get(self.url, headers=headers) as resp:
+                if resp.status == 200:
+                    raise RangeNotSupported("سرور فایل از Range پشتیبانی نمی‌کند")
+                resp.raise_for_status()
+                # Content-Range باید همین تکه از فایلی با همان حجم مورد انتظار باشد؛ در غیر این صورت دانلود عادی انجام می‌شود
+                content_range = resp.headers.get("Content-Range", "")
+                if content_range != f"bytes {start}-{end - 1}/{self.size}":
+                    raise RangeNotSupported(f"پاسخ Range نامعتبر برای تکه {index}: {content_range or 'بدون Content-Range'}")
+                written = 0
+                try:
+                    with open(self.path, "r+b") as f:
+                        f.seek(start)
+                        async for chunk in resp.content.iter_chunked(self.CHUNK):
+                            # بایت‌های اضافه هرگز در محدوده تکه بعدی نوشته نمی‌شوند
+                            chunk = chunk[:end - start - written]
+                            f.write(chunk)
+                            written += len(chunk)
+                            self.received += len(chunk)
+                            if self.on_progress:
+                                self.on_progress(self.received, self.size)
+                            if written == end - start:
+                                break
+                    if written != end - start:
+                        raise Exception(f"تکه {index} ناقص دریافت شد ({written} از {end - start} بایت)")
+                except BaseException:
+                    # تکه ناقص در شمارش پیشرفت حساب نمی‌شود و در تلاش بعدی از نو دریافت می‌شود
+                    self.received -= written
+                    raise
+        self.done.add(index)
+
+    async def run(self):
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as f:
+                f.truncate(self.size)
+        semaphore = asyncio.Semaphore(self.parallel)
+        pending = [i for i in range(len(self.segments)) if i not in self.done]
+        results = await asyncio.gather(*(self._fetch_segment(i, semaphore) for i in pending), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            for error in errors:
+                if isinstance(error, RangeNotSupported):
+                    raise error
+            logger.warning(f"⚠️ {len(errors)} تکه از {len(self.segments)} ناموفق بود؛ {len(self.done)} تکه نگه داشته شد.")
+            raise errors[0]
+        # فایل از ابتدا به اندازه کامل ساخته می‌شود؛ کامل بودن یعنی دریافت همه تکه‌ها
+        if len(self.done) != len(self.segments):
+            raise Exception(f"دانلود ناقص ماند ({len(self.done)} از {len(self.segments)} تکه)")
+
 # ----------------- مدیریت تلاش مجدد (Retry Helper) -----------------
-async def run_with_retry(coro_fn, max_retries=3, delay=2):
+async def run_with_retry(coro_fn, max_retries=3, delay=2, retry_on=Exception):
     for attempt in range(1, max_retries + 1):
         try:
             return await coro_fn()
-        except Exception as e:
+        except retry_on as e:
             logger.warning(f"⚠️ تلاش {attempt} از {max_retries} ناموفق بود: {e}")
             if attempt == max_retries:
                 raise e
-            await asyncio.sleep(delay)
+            RETRIES_TOTAL.inc()
+            if isinstance(e, RetryAfter):
+                # به جای تلاش کور، دقیقاً به اندازه زمان اعلام‌شده توسط تلگرام صبر می‌شود
+                outbound_scheduler.note_retry_after(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            else:
+                await asyncio.sleep(delay)
+
+# ----------------- صف ماندگار وظایف (Durable Task Queue) -----------------
+class DurableTaskQueue:
+    """صف وظایف مبتنی بر SQLite (حالت WAL) که با ری‌استارت کانتینر از بین نمی‌رود"""
+
+    ACTIVE_STATES = ('leased', 'downloading', 'transcoding', 'tagging', 'uploading')
+
+    def __init__(self, db_path: str, max_attempts: int, instance_id: str, lease_ttl: float, shared: bool = False,
+                 flush_delay: float = 0.05):
+        self.max_attempts = max_attempts
+        self.instance_id = instance_id
+        self.lease_ttl = lease_ttl
+        # در حالت مشترک، چند نسخه از یک جدول اجاره می‌گیرند و وظیفه نسخه از کار افتاده پس از انقضای اجاره دوباره تخصیص می‌یابد
+        self.shared = shared
+        self.flush_delay = flush_delay
+        # نوشتن‌ها و اجاره‌ها در thread اختصاصی انجام می‌شوند؛ در حالت مشترک ممکن است تا busy_timeout منتظر نسخه‌های دیگر بمانند
+        self._db = SqliteExecutor(db_path, "task-queue-db")
+        self._conn = self._db.conn
+        self._db.call(self._create_tables)
+        # شمارش صف از اتصال خواندنی جدا روی همان حلقه انجام می‌شود؛ خواندن در حالت WAL منتظر قفل نمی‌ماند
+        self._read_conn = sqlite3.connect(db_path)
+        # نوشتن‌ها در حافظه جمع می‌شوند و هر چند میلی‌ثانیه در یک تراکنش واحد ثبت می‌شوند
+        self._pending_inserts = []
+        self._pending_states = {}
+        self._flush_handle = None
+        self._flush_tasks = set()
+        self._inserted = None   # Future ثبت دسته فعلی درج‌ها که putها منتظر آن‌اند
+        self._lease_lock = asyncio.Lock()
+        self._ready = collections.deque()
+        self._getters = 0
+        self._last_served = {}
+        self._serve_counter = 0
+        self._wakeup = asyncio.Event()
+
+    def _create_tables(self):
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL,"
+            " status_msg_id INTEGER NOT NULL,"
+            " task_type TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'queued',"
+            " priority INTEGER NOT NULL DEFAULT 0,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+        if "priority" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN owner TEXT")
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN lease_until REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks(state, id)")
+
+    def _orphaned(self, now: float):
+        """شرط SQL وظایف فعالی که صاحبشان دیگر زنده نیست"""
+        placeholders = ",".join("?" * len(self.ACTIVE_STATES))
+        if not self.shared:
+            # تک‌نسخه‌ای: هر وظیفه فعال هنگام راه‌اندازی متعلق به اجرای قبلی همین ربات است
+            return f"state IN ({placeholders})", self.ACTIVE_STATES
+        return (
+            f"state IN ({placeholders}) AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+            (*self.ACTIVE_STATES, self.instance_id, now)
+        )
+
+    def recover(self):
+        """وظایف نیمه‌کاره اجرای قبلی را به صف برمی‌گرداند (یا در صورت عبور از سقف تلاش، شکست‌خورده ثبت می‌کند)"""
+        return self._db.call(self._recover)
+
+    def _recover(self):
+        now = time.time()
+        orphaned, params = self._orphaned(now)
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                f"UPDATE tasks SET state = 'failed', error = 'max attempts exceeded', updated_at = ?"
+                f" WHERE {orphaned} AND attempts >= ?",
+                (now, *params, self.max_attempts)
+            )
+            resumed = self._conn.execute(
+                f"SELECT id, chat_id, status_msg_id FROM tasks WHERE {orphaned}",
+                params
+            ).fetchall()
+            self._conn.execute(
+                f"UPDATE tasks SET state = 'queued', owner = NULL, updated_at = ? WHERE {orphaned}",
+                (now, *params)
+            )
+            # پاکسازی سوابق قدیمی وظایف پایان‌یافته
+            self._conn.execute(
+                "DELETE FROM tasks WHERE state IN ('done', 'failed') AND updated_at < ?",
+                (now - 7 * 86400,)
+            )
+        return resumed
+
+    async def put(self, chat_id: int, status_msg_id: int, task_type: str, payload, priority: int = PRIORITY_SINGLE):
+        now = time.time()
+        self._pending_inserts.append((chat_id, status_msg_id, task_type, json.dumps(payload), priority, now, now))
+        if self._inserted is None:
+            loop = asyncio.get_running_loop()
+            self._inserted = loop.create_future()
+            # putهای همزمان همین دور حلقه رویداد در یک تراکنش ثبت می‌شوند
+            loop.call_soon(self._start_flush)
+        # put تا ثبت ماندگار وظیفه برنمی‌گردد؛ کرش پس از آن وظیفه را از بین نمی‌برد
+        await asyncio.shield(self._inserted)
+
+    def wake(self):
+        """بیدار کردن ورکرهای منتظر صف (مثلاً تا ورکر کنارگذاشته‌شده متوجه توقف شود)"""
+        self._wakeup.set()
+
+    async def get(self, should_stop=None):
+        """وظیفه بعدی؛ اگر should_stop پیش از اجاره وظیفه جدید True شود، None برمی‌گردد"""
+        self._getters += 1
+        try:
+            while True:
+                if self._ready:
+                    return self._ready.popleft()
+                if should_stop is not None and should_stop():
+                    return None
+                # پیش از اجاره پاک می‌شود تا درجی که حین اجاره ثبت شود، بیدارباش را از دست ندهد
+                self._wakeup.clear()
+                async with self._lease_lock:
+                    if self._ready:
+                        continue
+                    await self._flush()
+                    # فقط به تعداد ورکرهای منتظر اجاره می‌شود تا ترتیب منصفانه با پیش‌خوانی زیاد از بین نرود
+                    pending = self._db.run(self._lease, self._getters)
+                    try:
+                        leased = await asyncio.shield(pending)
+                    except asyncio.CancelledError:
+                        # اجاره در thread ثبت می‌شود؛ وظایفش برای ورکرهای دیگر در _ready می‌مانند و گم نمی‌شوند
+                        pending.add_done_callback(self._keep_leased)
+                        raise
+                if leased:
+                    self._ready.extend(leased)
+                    continue
+                if not self.shared:
+                    await self._wakeup.wait()
+                    continue
+                # وظایف ثبت‌شده توسط نسخه‌های دیگر رویداد محلی ندارند؛ صف مشترک دوره‌ای بررسی می‌شود
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), QUEUE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._getters -= 1
+
+    def _keep_leased(self, future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            self._ready.extend(future.result())
+            self._wakeup.set()
+
+    def set_state(self, task_id: int, state: str, error: str = None):
+        if task_id is None:
+            return
+        self._pending_states[task_id] = (state, error)
+        self._schedule_flush()
+
+    def task_done(self, task_id: int, error: str = None):
+        self.set_state(task_id, 'failed' if error else 'done', error)
+
+    async def heartbeat(self, task_ids):
+        """تمدید اجاره وظایف در حال اجرای این نسخه"""
+        task_ids = [t for t in task_ids if t is not None]
+        if not task_ids:
+            return
+        renewed = await self._db.run(self._heartbeat, task_ids)
+        if renewed < len(task_ids):
+            logger.warning(f"⚠️ اجاره {len(task_ids) - renewed} وظیفه منقضی شده و به نسخه دیگری رسیده است.")
+
+    def _heartbeat(self, task_ids) -> int:
+        placeholders = ",".join("?" * len(task_ids))
+        with self._conn:
+            cur = self._conn.execute(
+                f"UPDATE tasks SET lease_until = ? WHERE owner = ? AND id IN ({placeholders})",
+                (time.time() + self.lease_ttl, self.instance_id, *task_ids)
+            )
+        return cur.rowcount
+
+    def qsize(self) -> int:
+        (queued,) = self._read_conn.execute("SELECT COUNT(*) FROM tasks WHERE state = 'queued'").fetchone()
+        return queued + len(self._ready) + len(self._pending_inserts)
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_delay, self._start_flush)
+
+    def _start_flush(self):
+        task = asyncio.create_task(self._flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"❌ خطا در ثبت تغییرات صف وظایف: {task.exception()}")
+
+    async def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending_inserts and not self._pending_states:
+            return
+        inserts, self._pending_inserts = self._pending_inserts, []
+        states, self._pending_states = self._pending_states, {}
+        inserted, self._inserted = self._inserted, None
+        # ارسال به thread بلافاصله پس از جداکردن دسته است، پس ترتیب دسته‌ها حفظ می‌شود؛
+        # نتیجه در callback اعمال می‌شود تا لغو flush (مثلاً لغو get) putهای منتظر را معلق نگذارد
+        write = self._db.run(self._write, inserts, states)
+        write.add_done_callback(functools.partial(self._written, inserted, bool(inserts)))
+        await asyncio.shield(write)
+
+    def _written(self, inserted, has_inserts: bool, future):
+        if inserted is not None and not inserted.done():
+            if future.cancelled():
+                inserted.cancel()
+            elif future.exception() is not None:
+                inserted.set_exception(future.exception())
+            else:
+                inserted.set_result(None)
+        if has_inserts and not future.cancelled() and future.exception() is None:
+            self._wakeup.set()
+
+    def _write(self, inserts, states):
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT INTO tasks (chat_id, status_msg_id, task_type, payload, priority, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                inserts
+            )
+            # وظیفه‌ای که اجاره‌اش به نسخه دیگری رسیده، با وضعیت این نسخه بازنویسی نمی‌شود
+            self._conn.executemany(
+                "UPDATE tasks SET state = ?, error = ?, updated_at = ? WHERE id = ? AND owner = ?",
+                [(state, error, now, task_id, self.instance_id) for task_id, (state, error) in states.items()]
+            )
+
+    def _lease(self, limit: int):
+        now = time.time()
+        available, params = "state = 'queued'", ()
+        if self.shared:
+            # وظیفه نسخه‌ای که heartbeat نفرستاده (از کار افتاده) دوباره قابل اجاره است
+            placeholders = ",".join("?" * len(self.ACTIVE_STATES))
+            expired = f"state IN ({placeholders}) AND lease_until < ?"
+            available, params = f"(state = 'queued' OR ({expired}))", (*self.ACTIVE_STATES, now)
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self.shared:
+                self._conn.execute(
+                    f"UPDATE tasks SET state = 'failed', error = 'max attempts exceeded', updated_at = ?"
+                    f" WHERE {expired} AND attempts >= ?",
+                    (now, *params, self.max_attempts)
+                )
+            # اول بر اساس اولویت، سپس نوبت چرخشی بین چت‌ها (n-امین وظیفه هر چت در دور n-ام)؛
+            # در هر دور، چتی که مدت بیشتری منتظر مانده زودتر سرویس می‌گیرد
+            candidates = self._conn.execute(
+                "SELECT id, chat_id, status_msg_id, task_type, payload, priority, turn FROM ("
+                " SELECT *, ROW_NUMBER() OVER (PARTITION BY priority, chat_id ORDER BY id) AS turn"
+                f" FROM tasks WHERE {available})"
+                " WHERE turn <= ?",
+                (*params, limit)
+            ).fetchall()
+            candidates.sort(key=lambda r: (r[5], r[6], self._last_served.get(r[1], 0), r[0]))
+            rows = [r[:5] for r in candidates[:limit]]
+            for row in rows:
+                self._serve_counter += 1
+                self._last_served[row[1]] = self._serve_counter
+            self._conn.executemany(
+                "UPDATE tasks SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                [(self.instance_id, now + self.lease_ttl, now, row[0]) for row in rows]
+            )
+        tasks = []
+        for task_id, chat_id, status_msg_id, task_type, payload in rows:
+            data = json.loads(payload)
+            if task_type == 'audio_file':
+                data = types.SimpleNamespace(**data)
+            tasks.append((task_id, chat_id, status_msg_id, task_type, data))
+        return tasks
+
+task_queue = DurableTaskQueue(STATE_DB_PATH, TASK_MAX_ATTEMPTS, INSTANCE_ID, LEASE_TTL, shared=coordinator.shared)
+
+async def heartbeat_loop():
+    """تمدید دوره‌ای اجاره وظایف و اسلات‌های سراسری این نسخه"""
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        try:
+            await task_queue.heartbeat(list(inflight_jobs))
+            await coordinator.heartbeat()
+        except sqlite3.Error as e:
+            logger.error(f"❌ خطا در ارسال heartbeat: {e}")
 
 # ----------------- مدیریت صف (Multi-Worker Queue) -----------------
+class WorkerPool:
+    """مدیریت ورکرهای صف؛ تعداد ورکرها بدون ری‌استارت و بر اساس عمق صف تغییر می‌کند"""
+
+    def __init__(self, min_workers: int, max_workers: int):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.workers = {}
+        self.busy = set()
+        self.retiring = set()
+        self._next_id = 1
+        self._app = None
+
+    def start(self, app: Application, count: int):
+        self._app = app
+        self.resize(count)
+
+    def resize(self, count: int):
+        count = max(self.min_workers, min(self.max_workers, count))
+        while len(self.workers) < count:
+            worker_id = self._next_id
+            self._next_id += 1
+            self.workers[worker_id] = asyncio.create_task(queue_worker(worker_id, self._app))
+        # ورکرهای بیکار لغو نمی‌شوند، فقط علامت می‌خورند؛ خودشان پیش از برداشتن وظیفه بعدی خارج می‌شوند
+        # تا لغو در میانه اجاره یا flush صف، وظیفه یا put منتظری را معلق نگذارد
+        retire = [w for w in self.workers if w not in self.busy][:max(0, len(self.workers) - count)]
+        for worker_id in retire:
+            self.workers.pop(worker_id)
+            self.retiring.add(worker_id)
+        if retire:
+            task_queue.wake()
+
+    async def autoscale(self, interval: float = 5.0):
+        while True:
+            await asyncio.sleep(interval)
+            target = len(self.busy) + task_queue.qsize()
+            if target > len(self.workers):
+                self.resize(target)
+            elif target < len(self.workers):
+                # کاهش تدریجی جهت جلوگیری از نوسان
+                self.resize(len(self.workers) - 1)
+
+worker_pool = WorkerPool(MIN_WORKERS, MAX_WORKERS)
+
 async def queue_worker(worker_id: int, app: Application):
     logger.info(f"⚙️ Worker-{worker_id} شروع به کار کرد.")
     while True:
-        task = await task_queue.get()
-        chat_id, status_msg_id, task_type, data = task
-        logger.info(f"👷 Worker-{worker_id} در حال انجام وظیفه نوع {task_type}")
+        # با پر بودن سهمیه فضای موقت، وظیفه جدید از صف برداشته نمی‌شود تا کار در میانه راه شکست نخورد
+        await temp_storage.budget.wait_for_room()
+        task = await task_queue.get(should_stop=lambda: worker_id in worker_pool.retiring)
+        if task is None:
+            worker_pool.retiring.discard(worker_id)
+            logger.info(f"💤 Worker-{worker_id} به دلیل خلوتی صف متوقف شد.")
+            return
+        task_id, chat_id, status_msg_id, task_type, data = task
+        worker_pool.busy.add(worker_id)
+        trace = job_traces[task_id] = JobTrace(task_id, task_type, worker_id, chat_id)
+        inflight_jobs[task_id] = {
+            "worker": worker_id, "chat_id": chat_id, "type": task_type, "job_id": trace.job_id,
+            "stage": "queued", "started": time.time(), "stage_started": time.time(),
+        }
+        logger.info(f"👷 Worker-{worker_id} در حال انجام وظیفه #{task_id} نوع {task_type}", extra={"fields": {"job_id": trace.job_id}})
+        error_details = None
         try:
             if task_type == 'audio_file':
-                await process_audio_file(app, chat_id, status_msg_id, data, worker_id)
+                await process_audio_file(app, chat_id, status_msg_id, data, worker_id, task_id)
             elif task_type == 'soundcloud_url':
-                await process_soundcloud_url(app, chat_id, status_msg_id, data, worker_id)
+                await process_soundcloud_url(app, chat_id, status_msg_id, data, worker_id, task_id)
         except Exception as e:
             error_details = str(e)
             logger.error(f"❌ Worker-{worker_id} - خطای نهایی: {error_details}", exc_info=True)
@@ -175,17 +1920,22 @@ async def queue_worker(worker_id: int, app: Application):
                 "💡 لطفاً مجدداً فایل یا لینک دیگری را ارسال کنید."
             )
             try:
-                await app.bot.edit_message_text(err_text, chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+                outbound_scheduler.edit_status(err_text, chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
             except Exception:
                 pass
         finally:
-            task_queue.task_done()
+            worker_pool.busy.discard(worker_id)
+            inflight_jobs.pop(task_id, None)
+            job_traces.pop(task_id, None)
+            logger.info(f"🧾 خلاصه وظیفه #{task_id} ({trace.job_id})", extra={"fields": trace.summary(error_details)})
+            TASKS_TOTAL.inc(type=task_type, result="failed" if error_details else "done")
+            task_queue.task_done(task_id, error_details)
 
 # ----------------- پردازش فایل صوتی تلگرام -----------------
-async def process_audio_file(app, chat_id, status_msg_id, doc_obj, worker_id: int):
+async def process_audio_file(app, chat_id, status_msg_id, doc_obj, worker_id: int, task_id: int = None):
     file_name = getattr(doc_obj, 'file_name', None) or "music.mp3"
-    duration = getattr(doc_obj, 'duration', 0)
-    file_size = getattr(doc_obj, 'file_size', 0)
+    duration = getattr(doc_obj, 'duration', 0) or 0
+    file_size = getattr(doc_obj, 'file_size', 0) or 0
 
     name_without_ext, ext = os.path.splitext(file_name)
     if not ext:
@@ -195,10 +1945,51 @@ async def process_audio_file(app, chat_id, status_msg_id, doc_obj, worker_id: in
     final_title = f"{clean_title} {CHANNEL_ID}"
     
     unique_id = uuid.uuid4().hex[:8]
-    new_filename = f"temp_{unique_id}_{final_title}{ext}"
+    temp_prefix = f"temp_{unique_id}_"
+    new_filename = temp_storage.path(f"{temp_prefix}{final_title}{ext}")
+
+    file_unique_id = getattr(doc_obj, 'file_unique_id', None)
+    cache_key = f"tg:{file_unique_id}" if file_unique_id else None
+    cached = repost_cache.get(cache_key) if cache_key else None
+
+    # فایل‌های کوچک کاملاً در حافظه دانلود، تگ و آپلود می‌شوند؛ بافر و کپی ارسال هر دو از سهمیه کم می‌شوند
+    # فایل‌هایی که تبدیل می‌شوند همیشه از مسیر دیسک می‌روند تا ffmpeg مستقیماً روی فایل کار کند
+    transcode = not cached and should_transcode(ext, file_size, duration)
+
+    memory_reserved = 0
+    if not cached and not transcode and 0 < file_size <= MEMORY_PATH_MAX_MB * 1024 * 1024 and memory_budget.try_reserve(file_size * 2):
+        memory_reserved = file_size * 2
+    buffer = io.BytesIO() if memory_reserved else None
+    disk_reserved = 0
+    temp_storage.claim(temp_prefix)
 
     try:
-        await app.bot.edit_message_text(
+        if cached:
+            logger.info(f"♻️ Worker-{worker_id} - فایل تکراری از کش بازنشر استفاده شد: {cache_key}")
+            caption = (
+                f"🎵 **{cached['title']}**\n\n"
+                f"⏱ **زمان:** {format_duration(cached['duration'])}\n"
+                f"💾 **حجم:** {format_size(cached['file_size'])}\n\n"
+                f"🆔 {CHANNEL_ID}"
+            )
+            message_id = await repost_from_cache(app, cache_key, cached, caption)
+            outbound_scheduler.edit_status(
+                f"♻️ **این فایل قبلاً در کانال منتشر شده است!**\n\n"
+                f"🎵 **عنوان:** `{cached['title']}`\n"
+                f"⏱ **زمان:** `{format_duration(cached['duration'])}` | 💾 **حجم:** `{format_size(cached['file_size'])}`",
+                chat_id=chat_id, message_id=status_msg_id, reply_markup=build_post_keyboard(message_id), parse_mode="Markdown"
+            )
+            return
+
+        if buffer is None:
+            # فایل اصلی و (در صورت تبدیل) خروجی ffmpeg همزمان روی دیسک هستند
+            need = temp_storage.clamp(file_size * (2 if transcode else 1) if file_size else TEMP_UNKNOWN_SIZE_MB * 1024 * 1024)
+            if not temp_storage.budget.try_reserve(need):
+                outbound_scheduler.edit_status("💽 **در انتظار آزاد شدن فضای موقت...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+                await temp_storage.budget.reserve(need)
+            disk_reserved = need
+
+        outbound_scheduler.edit_status(
             f"📥 **در حال دانلود فایل از تلگرام (Worker {worker_id})...**\n\n"
             f"🎵 **نام:** `{clean_title}`\n"
             f"💾 **حجم:** `{format_size(file_size)}`\n"
@@ -206,16 +1997,81 @@ async def process_audio_file(app, chat_id, status_msg_id, doc_obj, worker_id: in
             chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown"
         )
 
+        def download_progress(downloaded, total):
+            bar = make_progress_bar(downloaded / total * 100 if total > 0 else 0)
+            outbound_scheduler.edit_status(
+                f"📥 **در حال دانلود فایل از تلگرام (Worker {worker_id})...**\n\n{bar}",
+                chat_id=chat_id, message_id=status_msg_id
+            )
+
+        ranged = None
+        ranged_supported = True
         async def download_task():
+            nonlocal ranged, ranged_supported
             file = await app.bot.get_file(doc_obj.file_id)
+            if buffer is not None:
+                buffer.seek(0)
+                buffer.truncate()
+                await file.download_to_memory(buffer)
+                return
+            if ranged_supported and (file.file_size or 0) >= RANGED_MIN_MB * 1024 * 1024 and str(file.file_path).startswith(("http://", "https://")):
+                # لینک فایل ممکن است بین تلاش‌ها عوض شود، ولی تکه‌های کامل‌شده روی دیسک معتبر می‌مانند
+                if ranged is None:
+                    ranged = RangedDownload(
+                        file.file_path, new_filename, file.file_size,
+                        int(RANGED_SEGMENT_MB * 1024 * 1024), RANGED_PARALLEL, download_progress
+                    )
+                ranged.url = file.file_path
+                try:
+                    await ranged.run()
+                    return
+                except RangeNotSupported as e:
+                    logger.warning(f"⚠️ Worker-{worker_id} - {e}؛ دانلود یکجا انجام می‌شود.")
+                    ranged_supported = False
             await file.download_to_drive(custom_path=new_filename)
+            if file.file_size and os.path.getsize(new_filename) != file.file_size:
+                raise Exception(f"حجم فایل دانلودشده نادرست است ({os.path.getsize(new_filename)} به جای {file.file_size} بایت)")
+
+        task_queue.set_state(task_id, 'downloading')
+        async with download_limiter.slot(chat_id):
+            with timed_stage("tg_download", task_id):
+                await run_with_retry(download_task, max_retries=3)
+        BYTES_TOTAL.inc(buffer.tell() if buffer is not None else os.path.getsize(new_filename), direction="in")
+
+        if transcode and not await asyncio.shield(ensure_ffmpeg()):
+            logger.warning(f"⚠️ Worker-{worker_id} - ffmpeg در دسترس نیست؛ فایل بدون بهینه‌سازی آپلود می‌شود.")
+        elif transcode:
+            task_queue.set_state(task_id, 'transcoding')
+            outbound_scheduler.edit_status("🎛 **در حال بهینه‌سازی حجم فایل...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+            before = os.path.getsize(new_filename)
+            try:
+                async with transcode_limiter.slot(chat_id):
+                    with timed_stage("transcode", task_id):
+                        transcoded = await transcode_audio(new_filename)
+            except Exception as e:
+                logger.warning(f"⚠️ Worker-{worker_id} - بهینه‌سازی حجم ناموفق بود، فایل اصلی آپلود می‌شود: {e}")
+            else:
+                after = os.path.getsize(transcoded)
+                TRANSCODE_BYTES.inc(before, direction="before")
+                TRANSCODE_BYTES.inc(after, direction="after")
+                if after < before:
+                    logger.info(f"🎛 Worker-{worker_id} - بهینه‌سازی حجم: {format_size(before)} ← {format_size(after)} ({clean_title})")
+                    os.remove(new_filename)
+                    new_filename = transcoded
+                    ext = os.path.splitext(transcoded)[1]
+                    file_size = after
+                else:
+                    logger.info(f"🎛 Worker-{worker_id} - خروجی ffmpeg کوچک‌تر نبود ({format_size(before)} ← {format_size(after)})؛ فایل اصلی حفظ شد.")
+                    os.remove(transcoded)
 
-        await run_with_retry(download_task, max_retries=3)
-
-        await app.bot.edit_message_text("🎨 **در حال اعمال کاور اختصاصی و ویرایش متادیتا...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
-        await asyncio.to_thread(edit_metadata, new_filename, clean_title)
+        task_queue.set_state(task_id, 'tagging')
+        outbound_scheduler.edit_status("🎨 **در حال اعمال کاور اختصاصی و ویرایش متادیتا...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+        async with tag_limiter.slot(chat_id):
+            with timed_stage("tag", task_id):
+                await asyncio.to_thread(edit_metadata, new_filename, clean_title, buffer)
 
-        await app.bot.edit_message_text("📤 **در حال آپلود و انتشار در کانال...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+        task_queue.set_state(task_id, 'uploading')
+        outbound_scheduler.edit_status("📤 **در حال آپلود و انتشار در کانال...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
         caption = (
             f"🎵 **{final_title}**\n\n"
             f"⏱ **زمان:** {format_duration(duration)}\n"
@@ -226,10 +2082,13 @@ async def process_audio_file(app, chat_id, status_msg_id, doc_obj, worker_id: in
         sent_msg = None
         async def upload_task():
             nonlocal sent_msg
-            with open(new_filename, 'rb') as audio_file:
+            with (contextlib.nullcontext(buffer) if buffer is not None else open(new_filename, 'rb')) as audio_file:
+                audio_file.seek(0)
+                await outbound_scheduler.acquire(CHANNEL_ID)
                 sent_msg = await app.bot.send_audio(
                     chat_id=CHANNEL_ID,
                     audio=audio_file,
+                    filename=f"{final_title}{ext}",
                     caption=caption,
                     title=final_title,
                     performer=CHANNEL_ID,
@@ -237,17 +2096,20 @@ async def process_audio_file(app, chat_id, status_msg_id, doc_obj, worker_id: in
                     parse_mode="Markdown"
                 )
 
-        await run_with_retry(upload_task, max_retries=3)
+        async with upload_limiter.slot(chat_id):
+            with timed_stage("upload", task_id):
+                await run_with_retry(upload_task, max_retries=3)
+        BYTES_TOTAL.inc(len(buffer.getbuffer()) if buffer is not None else os.path.getsize(new_filename), direction="out")
 
-        channel_username = CHANNEL_ID.replace("@", "")
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("🎧 مشاهده در کانال", url=f"https://t.me/{channel_username}/{sent_msg.message_id}"),
-                InlineKeyboardButton("🗑 حذف از کانال", callback_data=f"del_{sent_msg.message_id}")
-            ]
-        ])
+        if sent_msg.audio:
+            # کلید دوم برای زمانی است که خود پست کانال دوباره برای ربات فوروارد شود
+            repost_cache.put(
+                [cache_key, f"tg:{sent_msg.audio.file_unique_id}"],
+                sent_msg.audio.file_id, sent_msg.message_id, final_title, duration, file_size
+            )
+        keyboard = build_post_keyboard(sent_msg.message_id)
 
-        await app.bot.edit_message_text(
+        outbound_scheduler.edit_status(
             f"✨ **پست با موفقیت در کانال منتشر شد!**\n\n"
             f"🎵 **عنوان:** `{final_title}`\n"
             f"⏱ **زمان:** `{format_duration(duration)}` | 💾 **حجم:** `{format_size(file_size)}`",
@@ -255,109 +2117,241 @@ async def process_audio_file(app, chat_id, status_msg_id, doc_obj, worker_id: in
         )
 
     finally:
+        if memory_reserved:
+            buffer.close()
+            await memory_budget.release(memory_reserved)
         if os.path.exists(new_filename):
             os.remove(new_filename)
             logger.info(f"🧹 فایل موقت پاک شد: {new_filename}")
+        temp_storage.unclaim(temp_prefix)
+        if disk_reserved:
+            await temp_storage.budget.release(disk_reserved)
 
 # ----------------- پردازش بدون گیر و بهینه‌شده ساندکلود -----------------
-async def process_soundcloud_url(app, chat_id, status_msg_id, url, worker_id: int):
-    unique_dir = f"sc_downloads_{uuid.uuid4().hex[:8]}"
+def estimate_track_size(entry: dict) -> int:
+    """حجم تقریبی ترک برای رزرو فضای موقت؛ از filesize اطلاعات yt-dlp یا مدت زمان با بیت‌ریت فرمت انتخابی (پیش‌فرض ۳۲۰ کیلوبیت)"""
+    size = entry.get('filesize') or entry.get('filesize_approx')
+    if not size and entry.get('duration'):
+        size = entry['duration'] * (entry.get('abr') or entry.get('tbr') or 320) * 1000 / 8
+    return int(size or TEMP_UNKNOWN_SIZE_MB * 1024 * 1024)
+
+def preview_track_size(entry: dict):
+    """حجم تقریبی نمایشی برای کاربر؛ برخلاف رزرو فضا، برای ترک بدون اطلاعات حدس بدبینانه نمی‌زند و None برمی‌گرداند"""
+    size = entry.get('filesize') or entry.get('filesize_approx')
+    if not size and entry.get('duration'):
+        size = entry['duration'] * (entry.get('abr') or entry.get('tbr') or SC_PREVIEW_KBPS) * 1000 / 8
+    return int(size) if size else None
+
+# کلیدهای مربوط به یک دانلود مشخص که نباید در اطلاعات کش‌شده ترک باقی بمانند
+DOWNLOAD_ONLY_KEYS = ('requested_downloads', 'filepath', '_filename', 'filename', '__files_to_move', '__postprocessors')
+
+def remember_track_info(info: dict):
+    """ذخیره اطلاعات کامل ترک (فرمت‌ها و لینک استریم انتخابی) تا دانلود بعدی بدون استخراج مجدد انجام شود"""
+    if info.get('id') and info.get('formats'):
+        cached = {k: v for k, v in info.items() if k not in DOWNLOAD_ONLY_KEYS}
+        sc_meta_cache.put(f"track:{info['id']}", cached, ttl=SC_STREAM_TTL)
+
+async def resolve_soundcloud(url: str):
+    """لیست ترک‌های لینک از کش متادیتا یا استخراج سطحی yt-dlp؛ خروجی (entries, از_کش)"""
+    entries = sc_meta_cache.get(f"list:{url}")
+    if entries is not None:
+        return entries, True
+    entries = await ytdl_pool.run({"op": "resolve", "url": url}, timeout=60.0)
+    # ترک‌هایی که کامل استخراج شده‌اند لینک استریم موقت دارند؛ لیست هم فقط به اندازه عمر آن لینک‌ها معتبر است
+    full = [e for e in entries if e.get('formats')]
+    for info in full:
+        remember_track_info(info)
+    sc_meta_cache.put(f"list:{url}", entries, ttl=SC_STREAM_TTL if full else SC_META_TTL)
+    return entries, False
+
+async def process_soundcloud_url(app, chat_id, status_msg_id, url, worker_id: int, task_id: int = None):
+    dir_name = f"sc_downloads_{uuid.uuid4().hex[:8]}"
+    unique_dir = temp_storage.path(dir_name)
     os.makedirs(unique_dir, exist_ok=True)
+    temp_storage.claim(dir_name)
 
-    await app.bot.edit_message_text("🔎 **در حال استخراج اطلاعات از ساندکلود...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
-
-    loop = asyncio.get_running_loop()
-    last_update_time = [0]
-
-    def ytdl_hook(d):
-        if d['status'] == 'downloading':
-            now = time.time()
-            if now - last_update_time[0] > 2.0:
-                last_update_time[0] = now
-                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
-                downloaded = d.get('downloaded_bytes', 0)
-                percent = (downloaded / total * 100) if total > 0 else 0
-                bar = make_progress_bar(percent)
-                msg = f"📥 **در حال دریافت موزیک از ساندکلود (Worker {worker_id})...**\n\n{bar}"
-                asyncio.run_coroutine_threadsafe(
-                    app.bot.edit_message_text(msg, chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown"),
-                    loop
-                )
+    outbound_scheduler.edit_status("🔎 **در حال استخراج اطلاعات از ساندکلود...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
 
-    # تنظیمات کاملاً سریع بدون انکود سنگین
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': f'{unique_dir}/%(title)s.%(ext)s',
-        'concurrent_fragment_downloads': 5,
-        'progress_hooks': [ytdl_hook],
-        'quiet': True,
-        'no_warnings': True,
-        'socket_timeout': 15,
-        'source_address': '0.0.0.0',
-        'hls_prefer_native': True,
-        'hls_use_mpegts': True,  # جلوگیری از مکث انتهایی فایل‌های HLS ساندکلود
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept-Language': 'en-US,en;q=0.9',
-        },
-    }
-
-    def download_sc():
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            tracks = []
-            if 'entries' in info:
-                for entry in info['entries']:
-                    if entry:
-                        tracks.append(entry)
-            else:
-                tracks.append(info)
-            return tracks
+    def download_progress(idx):
+        def on_progress(downloaded, total):
+            percent = (downloaded / total * 100) if total > 0 else 0
+            bar = make_progress_bar(percent)
+            outbound_scheduler.edit_status(
+                f"📥 **در حال دریافت ترک {idx} از {total_tracks} از ساندکلود (Worker {worker_id})...**\n\n{bar}",
+                chat_id=chat_id, message_id=status_msg_id
+            )
+        return on_progress
 
     try:
-        # افزایش تایم‌اوت به ۴ دقیقه جهت اطمینان
-        async with download_semaphore:
-            tracks_info = await asyncio.wait_for(
-                asyncio.to_thread(download_sc),
-                timeout=240.0
-            )
+        with timed_stage("ytdl_extract", task_id):
+            entries, from_cache = await resolve_soundcloud(url)
     except asyncio.TimeoutError:
-        if os.path.exists(unique_dir):
-            shutil.rmtree(unique_dir)
-        raise Exception("⏱ زمان دانلود از ساندکلود به پایان رسید (Timeout).")
+        shutil.rmtree(unique_dir, ignore_errors=True)
+        temp_storage.unclaim(dir_name)
+        raise Exception("⏱ زمان استخراج اطلاعات از ساندکلود به پایان رسید (Timeout).")
     except Exception as e:
-        if os.path.exists(unique_dir):
-            shutil.rmtree(unique_dir)
+        shutil.rmtree(unique_dir, ignore_errors=True)
+        temp_storage.unclaim(dir_name)
         err_msg = str(e)
         if "DRM protected" in err_msg:
             raise Exception("🔒 این ترک دارای قفل کپی‌رایت دیجیتال (DRM) است.")
         raise Exception(f"خطا در دریافت از ساندکلود: {err_msg}")
 
-    total_tracks = len(tracks_info)
-    channel_username = CHANNEL_ID.replace("@", "")
+    total_tracks = len(entries)
+    priority = PRIORITY_SINGLE if total_tracks == 1 else PRIORITY_PLAYLIST
+    logger.info(f"🎼 Worker-{worker_id} - {total_tracks} ترک از ساندکلود شناسایی شد{' (کش متادیتا)' if from_cache else ''}.")
+
+    # پیش‌نمایش فوری از روی استخراج سطحی، قبل از شروع دانلودها
+    # مدت و حجم فقط از ترک‌هایی که اطلاعات دارند جمع زده می‌شود و تعداد بقیه جداگانه اعلام می‌شود
+    durations = [e['duration'] for e in entries if e.get('duration')]
+    sizes = [size for size in map(preview_track_size, entries) if size]
+
+    def preview_total(values, fmt):
+        if not values:
+            return "نامشخص"
+        missing = total_tracks - len(values)
+        return fmt(sum(values)) + (f" (+{missing} ترک نامشخص)" if missing else "")
+
+    outbound_scheduler.edit_status(
+        f"🎼 **{total_tracks} ترک شناسایی شد**\n\n"
+        f"⏱ **مدت کل:** {preview_total(durations, format_duration)}\n"
+        f"💾 **حجم تقریبی:** {preview_total(sizes, format_size)}\n\n"
+        f"⏳ در حال آماده‌سازی دانلود...",
+        chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown"
+    )
 
-    try:
-        # یافتن فایل‌های دانلود شده بر اساس پسوندهای رایج
-        downloaded_files = [os.path.join(unique_dir, f) for f in os.listdir(unique_dir) if f.endswith(('.mp3', '.m4a', '.mp4', '.opus', '.ogg'))]
-
-        for idx, track in enumerate(tracks_info, start=1):
-            raw_title = track.get('title', 'Track')
-            duration = track.get('duration', 0)
-            clean_title = raw_title.replace(CHANNEL_ID, "").strip()
-            final_title = f"{clean_title} {CHANNEL_ID}"
-            
-            target_file = downloaded_files[idx - 1] if idx <= len(downloaded_files) else None
-
-            if target_file and os.path.exists(target_file):
+    # هر ترک مستقل از بقیه مراحل دانلود، تگ و آپلود را طی می‌کند؛ انتشار در کانال به ترتیب پلی‌لیست است
+    window = asyncio.Semaphore(SC_PIPELINE_WINDOW)
+    posted = [asyncio.Event() for _ in entries]
+    failed = []
+    uncertain = []
+
+    # حالت آلبوم: ترک‌های آماده در دسته‌های حداکثر ۱۰تایی با یک send_media_group منتشر می‌شوند
+    album = SC_ALBUM_MODE and total_tracks > 1
+    ready = [asyncio.get_running_loop().create_future() for _ in entries]
+    album_posted = [asyncio.Event() for _ in entries]
+
+    # فضای موقت به ترتیب پلی‌لیست رزرو می‌شود؛ پس ترکی که منتظر فضا است هیچ ترک قبلی را معطل نمی‌کند
+    reserve_turn = [asyncio.Event() for _ in entries]
+    disk_pressure = asyncio.Event()
+    disk_waiters = 0
+
+    refresh = None
+
+    async def refreshed_entry(idx, entry):
+        """اطلاعات تازه ترک وقتی لیست کش‌شده لینک، ترک‌های کامل با لینک استریم منقضی دارد؛ استخراج مجدد یک بار برای کل لینک انجام می‌شود"""
+        nonlocal refresh
+        if refresh is None:
+            sc_meta_cache.discard(f"list:{url}")
+            refresh = asyncio.ensure_future(resolve_soundcloud(url))
+        fresh, _ = await asyncio.shield(refresh)
+        match = next((e for e in fresh if e.get('id') and e.get('id') == entry.get('id')), None)
+        if match is None and len(fresh) == total_tracks:
+            match = fresh[idx - 1]
+        return match or entry
+
+    async def reserve_disk(nbytes):
+        nonlocal disk_waiters
+        if temp_storage.budget.try_reserve(nbytes):
+            return
+        disk_waiters += 1
+        disk_pressure.set()
+        try:
+            await temp_storage.budget.reserve(nbytes)
+        finally:
+            disk_waiters -= 1
+            if not disk_waiters:
+                disk_pressure.clear()
+
+    async def run_track(idx, entry):
+        track_id = entry.get('id')
+        cache_key = f"sc:{track_id}" if track_id else None
+        track_dir = os.path.join(unique_dir, f"{idx:03d}")
+        reserved = 0
+        try:
+            async with window:
+                cached = repost_cache.get(cache_key) if cache_key else None
+                if cached:
+                    logger.info(f"♻️ Worker-{worker_id} - ترک تکراری ساندکلود از کش بازنشر استفاده شد: {cache_key}")
+                    if album:
+                        ready[idx - 1].set_result({"idx": idx, "cache_key": cache_key, "cached": cached})
+                        return
+                    caption = (
+                        f"🎶 **{cached['title']}**\n\n"
+                        f"⏱ **زمان:** {format_duration(cached['duration'])}\n"
+                        f"💾 **حجم:** {format_size(cached['file_size'])}\n\n"
+                        f"🆔 {CHANNEL_ID}"
+                    )
+                    if idx > 1:
+                        await posted[idx - 2].wait()
+                    message_id = await repost_from_cache(app, cache_key, cached, caption)
+                    await outbound_scheduler.acquire(chat_id)
+                    await app.bot.send_message(
+                        chat_id=chat_id,
+                        text=f"♻️ **ترک {idx} از {total_tracks} قبلاً در کانال منتشر شده است:**\n`{cached['title']}`",
+                        reply_markup=build_post_keyboard(message_id),
+                        parse_mode="Markdown"
+                    )
+                    return
+
+                if idx > 1:
+                    await reserve_turn[idx - 2].wait()
+                need = temp_storage.clamp(estimate_track_size(entry))
+                await reserve_disk(need)
+                reserved = need
+                reserve_turn[idx - 1].set()
+
+                task_queue.set_state(task_id, 'downloading')
+                # اطلاعات کامل کش‌شده ترک، استخراج مجدد در پروسه yt-dlp را حذف می‌کند
+                is_flat = entry.get('_type') in ('url', 'url_transparent')
+                info_key = f"track:{track_id}" if track_id else None
+                cached_info = sc_meta_cache.get(info_key) if info_key and is_flat else None
+                job_entry = cached_info or entry
+                # لینک‌های استریم اطلاعات کش‌شده (کش ترک یا ترک کامل داخل کش لیست) ممکن است منقضی شده باشند
+                may_be_stale = cached_info is not None or (from_cache and not is_flat)
+                attempts = SC_TRACK_RETRIES + (1 if may_be_stale else 0)
+                for attempt in range(1, attempts + 1):
+                    attempt_dir = os.path.join(track_dir, str(attempt))
+                    try:
+                        # در صورت تایم‌اوت، پروسه yt-dlp همان لحظه kill می‌شود و چیزی در پس‌زمینه ادامه نمی‌یابد
+                        async with download_limiter.slot(chat_id, priority):
+                            with timed_stage("ytdl_download", task_id):
+                                result = await ytdl_pool.run(
+                                    {"op": "download", "entry": job_entry, "dir": os.path.abspath(attempt_dir)},
+                                    timeout=SC_TRACK_TIMEOUT, on_progress=download_progress(idx)
+                                )
+                        track, target_file = result["info"], result["filepath"]
+                        if not target_file or not os.path.exists(target_file):
+                            raise Exception("فایل دانلودشده یافت نشد.")
+                        remember_track_info(track)
+                        break
+                    except Exception as e:
+                        err_msg = "Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+                        logger.warning(f"⚠️ دانلود ترک {idx} - تلاش {attempt} از {attempts} ناموفق بود: {err_msg}")
+                        if may_be_stale:
+                            # لینک استریم کش‌شده احتمالاً منقضی شده؛ تلاش بعدی با استخراج تازه
+                            may_be_stale = False
+                            if cached_info is not None:
+                                sc_meta_cache.discard(info_key)
+                                job_entry = entry
+                            else:
+                                job_entry = await refreshed_entry(idx, entry)
+                        elif attempt == attempts or "DRM protected" in err_msg:
+                            raise Exception(err_msg)
+
+                raw_title = track.get('title', 'Track')
+                duration = track.get('duration', 0) or 0
+                clean_title = raw_title.replace(CHANNEL_ID, "").strip()
+                final_title = f"{clean_title} {CHANNEL_ID}"
                 file_size = os.path.getsize(target_file)
-                
-                await app.bot.edit_message_text(
-                    f"🎨 **در حال تنظیم متادیتا و کاور ({idx}/{total_tracks}):**\n`{clean_title}`",
-                    chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown"
-                )
-                await asyncio.to_thread(edit_metadata, target_file, clean_title)
+                BYTES_TOTAL.inc(file_size, direction="in")
+
+                task_queue.set_state(task_id, 'tagging')
+                async with tag_limiter.slot(chat_id, priority):
+                    with timed_stage("tag", task_id):
+                        await asyncio.to_thread(edit_metadata, target_file, clean_title)
 
-                await app.bot.edit_message_text(
+                outbound_scheduler.edit_status(
                     f"📤 **در حال انتشار در کانال ({idx}/{total_tracks}):**\n`{clean_title}`",
                     chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown"
                 )
@@ -369,10 +2363,17 @@ async def process_soundcloud_url(app, chat_id, status_msg_id, url, worker_id: in
                     f"🆔 {CHANNEL_ID}"
                 )
 
+                if album:
+                    ready[idx - 1].set_result({
+                        "idx": idx, "cache_key": cache_key, "path": target_file, "title": final_title,
+                        "duration": int(duration), "file_size": file_size, "caption": caption,
+                    })
+
                 sent_msg = None
                 async def upload_sc_task():
                     nonlocal sent_msg
                     with open(target_file, 'rb') as audio_file:
+                        await outbound_scheduler.acquire(CHANNEL_ID)
                         sent_msg = await app.bot.send_audio(
                             chat_id=CHANNEL_ID,
                             audio=audio_file,
@@ -383,27 +2384,214 @@ async def process_soundcloud_url(app, chat_id, status_msg_id, url, worker_id: in
                             parse_mode="Markdown"
                         )
 
-                await run_with_retry(upload_sc_task, max_retries=3)
+                if album:
+                    return
+
+                if idx > 1:
+                    await posted[idx - 2].wait()
+                task_queue.set_state(task_id, 'uploading')
+                async with upload_limiter.slot(chat_id, priority):
+                    with timed_stage("upload", task_id):
+                        await run_with_retry(upload_sc_task, max_retries=3)
+                BYTES_TOTAL.inc(os.path.getsize(target_file), direction="out")
 
-                keyboard = InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton("🎧 مشاهده در کانال", url=f"https://t.me/{channel_username}/{sent_msg.message_id}"),
-                        InlineKeyboardButton("🗑 حذف از کانال", callback_data=f"del_{sent_msg.message_id}")
-                    ]
-                ])
+                if sent_msg.audio:
+                    repost_cache.put(
+                        [cache_key, f"tg:{sent_msg.audio.file_unique_id}"],
+                        sent_msg.audio.file_id, sent_msg.message_id, final_title, duration, file_size
+                    )
 
+                await outbound_scheduler.acquire(chat_id)
                 await app.bot.send_message(
                     chat_id=chat_id,
                     text=f"✅ **ترک {idx} از {total_tracks} با موفقیت منتشر شد:**\n`{final_title}`",
-                    reply_markup=keyboard,
+                    reply_markup=build_post_keyboard(sent_msg.message_id),
                     parse_mode="Markdown"
                 )
 
-                os.remove(target_file)
+        except Exception as e:
+            err_msg = str(e)
+            logger.error(f"❌ Worker-{worker_id} - خطا در پردازش ترک {idx}: {err_msg}")
+            failed.append(idx)
+            if "DRM protected" in err_msg:
+                err_msg = "🔒 این ترک دارای قفل کپی‌رایت دیجیتال (DRM) است."
+            try:
+                await outbound_scheduler.acquire(chat_id)
+                await app.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"❌ **ترک {idx} از {total_tracks} منتشر نشد:**\n`{err_msg[:200]}`",
+                    parse_mode="Markdown"
+                )
+            except Exception:
+                pass
+        finally:
+            reserve_turn[idx - 1].set()
+            if not ready[idx - 1].done():
+                ready[idx - 1].set_result(None)
+            elif album and ready[idx - 1].result():
+                # فایل ترک تا انتشار آلبوم آن روی دیسک می‌ماند
+                await album_posted[idx - 1].wait()
+            posted[idx - 1].set()
+            # فضای دیسک هر ترک بلافاصله پس از انتشار آزاد می‌شود
+            shutil.rmtree(track_dir, ignore_errors=True)
+            if reserved:
+                await temp_storage.budget.release(reserved)
+
+    async def send_track(item):
+        """انتشار تکی یک ترک آماده (آلبوم یک‌ترکی یا بازگشت پس از شکست آلبوم)"""
+        sent_msg = None
+        async def upload_single():
+            nonlocal sent_msg
+            with (open(item["path"], 'rb') if "path" in item else contextlib.nullcontext(item["cached"]["file_id"])) as audio:
+                await outbound_scheduler.acquire(CHANNEL_ID)
+                sent_msg = await app.bot.send_audio(
+                    chat_id=CHANNEL_ID, audio=audio, caption=item["caption"], title=item["title"],
+                    performer=CHANNEL_ID, duration=item["duration"], parse_mode="Markdown"
+                )
+        await run_with_retry(upload_single, max_retries=3)
+        return sent_msg
+
+    async def publish_album(batch_no, items):
+        for item in items:
+            if "cached" in item:
+                cached = item["cached"]
+                item.update(title=cached["title"], duration=cached["duration"], file_size=cached["file_size"], caption=(
+                    f"🎶 **{cached['title']}**\n\n"
+                    f"⏱ **زمان:** {format_duration(cached['duration'])}\n"
+                    f"💾 **حجم:** {format_size(cached['file_size'])}\n\n"
+                    f"🆔 {CHANNEL_ID}"
+                ))
+        # ترک‌هایی که پست معتبرشان در کانال هست دوباره منتشر نمی‌شوند و فقط لینکشان در خلاصه می‌آید
+        existing = [item for item in items if "cached" in item and item["cached"]["message_id"]]
+        to_send = [item for item in items if item not in existing]
+        sent = {}
+
+        def record(item, msg):
+            sent[item["idx"]] = msg
+            if msg.audio:
+                repost_cache.put(
+                    [item["cache_key"], f"tg:{msg.audio.file_unique_id}"],
+                    msg.audio.file_id, msg.message_id, item["title"], item["duration"], item["file_size"]
+                )
 
-        await app.bot.edit_message_text("🎉 **تمامی ترک‌های ساندکلود با موفقیت منتشر شدند!**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+        task_queue.set_state(task_id, 'uploading')
+        async with upload_limiter.slot(chat_id, priority):
+            with timed_stage("upload", task_id):
+                if len(to_send) > 1:
+                    messages = None
+                    # تایم‌اوت به نسبت حجم کل آلبوم؛ پیش‌فرض کتابخانه برای چند ده مگابایت کافی نیست و آپلود موفق را قطع می‌کند
+                    upload_bytes = sum(item["file_size"] for item in to_send if "path" in item)
+                    upload_timeout = 30 + upload_bytes / (ALBUM_UPLOAD_MIN_KBPS * 1024)
+                    async def upload_group():
+                        nonlocal messages
+                        with contextlib.ExitStack() as stack:
+                            media = [
+                                InputMediaAudio(
+                                    media=stack.enter_context(open(item["path"], 'rb')) if "path" in item else item["cached"]["file_id"],
+                                    caption=item["caption"], parse_mode="Markdown", title=item["title"],
+                                    performer=CHANNEL_ID, duration=item["duration"]
+                                )
+                                for item in to_send
+                            ]
+                            await outbound_scheduler.acquire(CHANNEL_ID)
+                            messages = await app.bot.send_media_group(
+                                chat_id=CHANNEL_ID, media=media, write_timeout=upload_timeout, read_timeout=upload_timeout
+                            )
+                    try:
+                        # فقط RetryAfter تکرار می‌شود؛ در آن حالت تلگرام قطعاً چیزی منتشر نکرده است
+                        await run_with_retry(upload_group, max_retries=3, retry_on=RetryAfter)
+                        for item, msg in zip(to_send, messages):
+                            record(item, msg)
+                    except BadRequest as e:
+                        # رد قطعی آلبوم از سمت API: ترک‌ها تکی منتشر می‌شوند تا ترک معیوب بقیه را از دست ندهد
+                        logger.warning(f"⚠️ Worker-{worker_id} - انتشار آلبوم {batch_no + 1} رد شد، انتشار تکی ترک‌ها: {e}")
+                    except NetworkError as e:
+                        # قطع ارتباط یا تایم‌اوت: ممکن است آلبوم منتشر شده باشد؛ ارسال دوباره پست تکراری می‌سازد
+                        logger.error(f"❌ Worker-{worker_id} - وضعیت انتشار آلبوم {batch_no + 1} نامشخص است، ارسال دوباره انجام نمی‌شود: {e}")
+                        uncertain.extend(item["idx"] for item in to_send)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Worker-{worker_id} - انتشار آلبوم {batch_no + 1} ناموفق بود، انتشار تکی ترک‌ها: {e}")
+
+                for item in to_send:
+                    if item["idx"] in sent or item["idx"] in uncertain:
+                        continue
+                    try:
+                        record(item, await send_track(item))
+                    except Exception as e:
+                        logger.error(f"❌ Worker-{worker_id} - خطا در انتشار ترک {item['idx']}: {e}")
+                        failed.append(item["idx"])
+        BYTES_TOTAL.inc(sum(item["file_size"] for item in to_send if item["idx"] in sent and "path" in item), direction="out")
+
+        posts = sorted(
+            [(item["idx"], sent[item["idx"]].message_id) for item in to_send if item["idx"] in sent]
+            + [(item["idx"], item["cached"]["message_id"]) for item in existing]
+        )
+        new_ids = [msg.message_id for msg in sent.values()]
+        group_id = await repost_cache.add_group(new_ids) if len(new_ids) > 1 else None
+        lines = [
+            f"{'♻️' if item in existing else '✅' if item['idx'] in sent else '❓' if item['idx'] in uncertain else '❌'} {item['idx']}. `{item['title']}`"
+            for item in sorted(items, key=lambda i: i["idx"])
+        ]
+        await outbound_scheduler.acquire(chat_id)
+        await app.bot.send_message(
+            chat_id=chat_id,
+            text=f"📦 **آلبوم {batch_no + 1} منتشر شد ({len(sent)} ترک جدید):**\n\n" + "\n".join(lines),
+            reply_markup=build_group_keyboard(posts, group_id) if posts else None,
+            parse_mode="Markdown"
+        )
+
+    async def run_albums():
+        pending = list(range(total_tracks))
+        batch_no = 0
+        while pending:
+            head = pending[:SC_ALBUM_SIZE]
+            while True:
+                prefix = list(itertools.takewhile(lambda i: ready[i].done(), head))
+                if len(prefix) == len(head):
+                    break
+                if disk_pressure.is_set():
+                    # ترکی منتظر فضای موقت است: ترک‌هایی که فضا را نگه داشته‌اند بدون انتظار برای آلبوم کامل منتشر می‌شوند
+                    holders = list(itertools.takewhile(lambda i: reserve_turn[i].is_set(), head))
+                    waiting = [ready[i] for i in holders if not ready[i].done()]
+                    if holders and not waiting:
+                        break
+                    await asyncio.wait(waiting or [ready[head[0]]])
+                    continue
+                pressure = asyncio.ensure_future(disk_pressure.wait())
+                await asyncio.wait([ready[i] for i in head if not ready[i].done()] + [pressure], return_when=asyncio.FIRST_COMPLETED)
+                pressure.cancel()
+            del pending[:len(prefix)]
+            try:
+                items = [ready[i].result() for i in prefix if ready[i].result()]
+                if items:
+                    await publish_album(batch_no, items)
+                    batch_no += 1
+            except Exception as e:
+                logger.error(f"❌ Worker-{worker_id} - خطا در انتشار آلبوم {batch_no + 1}: {e}")
+            finally:
+                for i in prefix:
+                    album_posted[i].set()
+
+    try:
+        await asyncio.gather(
+            *(run_track(idx, entry) for idx, entry in enumerate(entries, start=1)),
+            *([run_albums()] if album else [])
+        )
+
+        if len(failed) == total_tracks:
+            raise Exception("هیچ‌کدام از ترک‌های ساندکلود منتشر نشدند.")
+        if failed or uncertain:
+            text = f"⚠️ **{total_tracks - len(failed) - len(uncertain)} از {total_tracks} ترک منتشر شد.**"
+            if failed:
+                text += f"\n❌ **ترک‌های ناموفق:** `{', '.join(map(str, sorted(failed)))}`"
+            if uncertain:
+                text += f"\n❓ **وضعیت نامشخص (کانال را بررسی کنید):** `{', '.join(map(str, sorted(uncertain)))}`"
+            outbound_scheduler.edit_status(text, chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+        else:
+            outbound_scheduler.edit_status("🎉 **تمامی ترک‌های ساندکلود با موفقیت منتشر شدند!**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
 
     finally:
+        temp_storage.unclaim(dir_name)
         if os.path.exists(unique_dir):
             shutil.rmtree(unique_dir)
             logger.info(f"🧹 پوشه موقت {unique_dir} کاملاً پاکسازی شد.")
@@ -413,10 +2601,38 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
 
-    if query.data.startswith("del_"):
+    if query.data.startswith("delg_"):
+        group_id = int(query.data.split("_")[1])
+        message_ids = repost_cache.get_group(group_id)
+        if message_ids is None:
+            await query.edit_message_text("⚠️ **این آلبوم قبلاً حذف شده یا اطلاعات آن منقضی شده است.**", parse_mode="Markdown")
+            return
+        # نسخه فعلی کتابخانه deleteMessages ندارد؛ پیام‌ها یکی‌یکی از مسیر زمان‌بند حذف می‌شوند
+        errors = []
+        for message_id in message_ids:
+            try:
+                await outbound_scheduler.acquire(CHANNEL_ID)
+                await context.bot.delete_message(chat_id=CHANNEL_ID, message_id=message_id)
+            except BadRequest as e:
+                # پیامی که قبلاً پاک شده مانع حذف بقیه آلبوم نیست
+                logger.warning(f"⚠️ حذف پست {message_id} آلبوم ناموفق بود: {e}")
+            except Exception as e:
+                errors.append(message_id)
+                logger.error(f"❌ خطا در حذف پست {message_id} آلبوم از کانال: {e}")
+                continue
+            repost_cache.forget_message(message_id)
+        if errors:
+            await query.message.reply_text(f"❌ **حذف {len(errors)} پست از آلبوم ناموفق بود؛ دوباره تلاش کنید.**", parse_mode="Markdown")
+            return
+        repost_cache.forget_group(group_id)
+        await query.edit_message_text(f"🗑 **آلبوم ({len(message_ids)} پست) با موفقیت از کانال حذف شد.**", parse_mode="Markdown")
+
+    elif query.data.startswith("del_"):
         msg_id_to_delete = int(query.data.split("_")[1])
         try:
+            await outbound_scheduler.acquire(CHANNEL_ID)
             await context.bot.delete_message(chat_id=CHANNEL_ID, message_id=msg_id_to_delete)
+            repost_cache.forget_message(msg_id_to_delete)
             await query.edit_message_text("🗑 **پست مورد نظر با موفقیت از کانال حذف شد.**", parse_mode="Markdown")
         except Exception as e:
             logger.error(f"❌ خطا در حذف پست از کانال: {e}")
@@ -454,30 +2670,109 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"🎵 فایل صوتی جدید افزوده‌شده به صف: {file_name}")
 
         status_msg = await msg.reply_text("📥 **فایل دریافت شد! در صف پردازش قرار گرفت...**", parse_mode="Markdown")
-        await task_queue.put((msg.chat_id, status_msg.message_id, 'audio_file', doc_obj))
+        payload = {
+            'file_id': doc_obj.file_id,
+            'file_unique_id': doc_obj.file_unique_id,
+            'file_name': getattr(doc_obj, 'file_name', None),
+            'duration': getattr(doc_obj, 'duration', 0) or 0,
+            'file_size': getattr(doc_obj, 'file_size', 0) or 0,
+        }
+        await task_queue.put(msg.chat_id, status_msg.message_id, 'audio_file', payload)
 
     elif msg.text and ("soundcloud.com" in msg.text):
         logger.info(f"🔗 لینک ساندکلود جدید افزوده‌شده به صف: {msg.text}")
         status_msg = await msg.reply_text("🔗 **لینک ساندکلود در صف قرار گرفت...**", parse_mode="Markdown")
-        await task_queue.put((msg.chat_id, status_msg.message_id, 'soundcloud_url', msg.text))
+        priority = PRIORITY_PLAYLIST if "/sets/" in msg.text else PRIORITY_SINGLE
+        await task_queue.put(msg.chat_id, status_msg.message_id, 'soundcloud_url', msg.text, priority)
 
 # ----------------- اجرای اصلی -----------------
+def log_startup_report():
+    report = " | ".join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in startup_timings.items())
+    logger.info(f"⏱ گزارش زمان راه‌اندازی: {report}")
+
+async def note_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if "first_update" not in startup_timings:
+        mark_startup("first_update")
+        log_startup_report()
+
+async def warm_up():
+    """بارگذاری پس‌زمینه ماژول‌ها و منابع سنگین، پس از آنکه دریافت آپدیت‌ها فعال شد"""
+    try:
+        await asyncio.to_thread(cover_art.get)
+        await ytdl_pool.warm()
+        # ffmpeg فقط برای مرحله تبدیل لازم است؛ بدون آن، static_ffmpeg هیچ‌وقت دانلود و باز نمی‌شود
+        if TRANSCODE_ENABLED:
+            await asyncio.shield(ensure_ffmpeg())
+        mark_startup("warm_up_done")
+        log_startup_report()
+    except Exception as e:
+        logger.error(f"❌ خطا در گرم‌سازی پس‌زمینه: {e}")
+
+async def start_ingest(app: Application):
+    """دریافت آپدیت‌ها با وبهوک روی وب‌سرور موجود؛ در صورت نبود آدرس یا خطا، polling"""
+    if WEBHOOK_URL:
+        try:
+            # در حالت چندنسخه‌ای فقط اولین نسخه وبهوک را ثبت می‌کند؛ بقیه همان ثبت (با توکن مخفی یکسان) را می‌پذیرند
+            if coordinator.shared and (await app.bot.get_webhook_info()).url == WEBHOOK_URL + WEBHOOK_PATH:
+                logger.info(f"🪝 وبهوک از قبل توسط نسخه دیگری ثبت شده است: {WEBHOOK_URL}{WEBHOOK_PATH}")
+                return
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=max(1, min(100, UPDATE_CONCURRENCY)),
+            )
+            logger.info(f"🪝 حالت وبهوک فعال شد: {WEBHOOK_URL}{WEBHOOK_PATH}")
+            return
+        except Exception as e:
+            if coordinator.shared:
+                # polling وبهوک را برای همه نسخه‌ها حذف می‌کند؛ این نسخه فقط از مسیر وبهوک آپدیت می‌گیرد
+                logger.error(f"❌ ثبت وبهوک ناموفق بود؛ در حالت چندنسخه‌ای به polling برنمی‌گردیم: {e}")
+                return
+            logger.error(f"❌ ثبت وبهوک ناموفق بود، بازگشت به حالت polling: {e}")
+    # start_polling خودش وبهوک قبلی را حذف می‌کند
+    await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("📡 حالت polling فعال شد.")
+
 async def main():
+    mark_startup("main")
     clean_old_temp_files()
-    await start_web_server()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = Application.builder().token(BOT_TOKEN).concurrent_updates(UPDATE_CONCURRENCY).build()
+    await start_web_server(app)
+    mark_startup("web_server")
+    app.add_handler(TypeHandler(Update, note_first_update), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(handle_callback_query))
     app.add_handler(MessageHandler(filters.AUDIO | filters.Document.ALL | filters.VOICE | filters.TEXT, handle_message))
 
-    for i in range(1, NUM_WORKERS + 1):
-        asyncio.create_task(queue_worker(i, app))
-
-    logger.info(f"🤖 ربات با {NUM_WORKERS} ورکر همزمان استارت شد...")
+    logger.info(f"♻️ وضعیت کش بازنشر: {repost_cache.stats()}")
     await app.initialize()
     await app.start()
-    await app.updater.start_polling()
+    mark_startup("telegram_ready")
+    asyncio.create_task(outbound_scheduler.run(app.bot))
+
+    # وظایف نیمه‌کاره اجرای قبلی پیش از شروع ورکرها به صف برمی‌گردند
+    resumed = task_queue.recover()
+    if resumed:
+        logger.info(f"🔄 {len(resumed)} وظیفه نیمه‌کاره از اجرای قبلی دوباره در صف قرار گرفت.")
+    for _, chat_id, status_msg_id in resumed:
+        try:
+            outbound_scheduler.edit_status("🔄 **ربات مجدداً راه‌اندازی شد؛ پردازش این مورد از سر گرفته می‌شود...**", chat_id=chat_id, message_id=status_msg_id, parse_mode="Markdown")
+        except Exception:
+            pass
+
+    worker_pool.start(app, NUM_WORKERS)
+    asyncio.create_task(worker_pool.autoscale())
+    asyncio.create_task(temp_storage.sweep_loop(TEMP_SWEEP_INTERVAL))
+    asyncio.create_task(heartbeat_loop())
+
+    logger.info(f"🤖 ربات با {len(worker_pool.workers)} ورکر همزمان استارت شد (حداقل {MIN_WORKERS}، حداکثر {MAX_WORKERS})...")
+    await start_ingest(app)
+    mark_startup("ingest_started")
+    log_startup_report()
+    if WARMUP_ENABLED:
+        asyncio.create_task(warm_up())
 
     await asyncio.Event().wait()
 
@@ -0,0 +1,104 @@
+"""پروسه کارگر yt-dlp برای bot.py
+
+هر پروسه یک نمونه گرم YoutubeDL (به همراه client_id ساندکلود و سایر وضعیت استخراج‌کننده‌ها)
+را بین کارها نگه می‌دارد. پروتکل روی stdin/stdout به صورت JSON خط‌به‌خط است:
+
+    ورودی اول:  {"opts": {...}}
+    هر کار:     {"op": "resolve", "url": "..."}  یا  {"op": "download", "entry": {...}, "dir": "..."}
+    خروجی:      {"type": "progress", ...} / {"type": "result", "data": ...} / {"type": "error", "message": "..."}
+"""
+import os
+import sys
+import json
+import time
+
+def fill_soundcloud_details(ydl, info: dict, entries: list):
+    """ترک‌های پلی‌لیست ساندکلود در استخراج سطحی (به جز چند ترک اول) مدت و عنوان ندارند؛
+    این اطلاعات با درخواست‌های دسته‌ای (هر ۵۰ ترک یک درخواست) از API ساندکلود تکمیل می‌شود تا پیش‌نمایش دقیق باشد"""
+    missing = [e for e in entries if e.get('ie_key') == 'Soundcloud' and e.get('id') and not e.get('duration')]
+    if not missing or not str(info.get('extractor_key', '')).startswith('Soundcloud'):
+        return
+    try:
+        # همان نمونه استخراج‌کننده پلی‌لیست که client_id و هدرهای ورود را از قبل دارد
+        ie = ydl.get_info_extractor(info['extractor_key'])
+        details = {}
+        for start in range(0, len(missing), 50):
+            batch_ids = [str(e['id']) for e in missing[start:start + 50]]
+            tracks = ie._call_api(
+                ie._API_V2_BASE + 'tracks', info.get('id'), 'Downloading track details',
+                query={'ids': ','.join(batch_ids)}, headers=ie._HEADERS, fatal=False
+            ) or []
+            details.update((str(t.get('id')), t) for t in tracks if isinstance(t, dict))
+    except Exception:
+        # پیش‌نمایش بدون این اطلاعات هم کار می‌کند؛ خطا نباید استخراج را از کار بیندازد
+        return
+    for e in missing:
+        track = details.get(str(e['id']))
+        if not track:
+            continue
+        if track.get('duration'):
+            e['duration'] = track['duration'] / 1000
+        if track.get('title') and not e.get('title'):
+            e['title'] = track['title']
+
+def main():
+    # stdout فقط برای پروتکل است؛ هر چاپ احتمالی yt-dlp به stderr هدایت می‌شود
+    proto = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    def send(message: dict):
+        proto.write(json.dumps(message, ensure_ascii=False) + "\n")
+        proto.flush()
+
+    init = json.loads(sys.stdin.readline())
+
+    import yt_dlp
+
+    last_progress = [0.0]
+
+    def progress_hook(d):
+        if d['status'] == 'downloading':
+            now = time.time()
+            if now - last_progress[0] > 1.0:
+                last_progress[0] = now
+                send({
+                    "type": "progress",
+                    "downloaded": d.get('downloaded_bytes', 0),
+                    "total": d.get('total_bytes') or d.get('total_bytes_estimate') or 0,
+                })
+
+    ydl = yt_dlp.YoutubeDL({**init["opts"], 'progress_hooks': [progress_hook], 'noprogress': True})
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            if job["op"] == "resolve":
+                # استخراج سطحی پلی‌لیست: فقط لیست ترک‌ها، بدون دریافت اطلاعات استریم هر ترک
+                ydl.params['extract_flat'] = 'in_playlist'
+                info = ydl.extract_info(job["url"], download=False)
+                entries = [e for e in info['entries'] if e] if 'entries' in info else [info]
+                if 'entries' in info:
+                    fill_soundcloud_details(ydl, info, entries)
+                send({"type": "result", "data": [ydl.sanitize_info(e) for e in entries]})
+
+            elif job["op"] == "download":
+                ydl.params['extract_flat'] = False
+                ydl.params['paths'] = {'home': job["dir"]}
+                entry = job["entry"]
+                last_progress[0] = 0.0
+                if entry.get('_type') in ('url', 'url_transparent'):
+                    result = ydl.extract_info(entry['url'], download=True)
+                else:
+                    # لینک تک‌ترک از قبل کامل استخراج شده و نیازی به استخراج مجدد نیست
+                    result = ydl.process_ie_result(entry, download=True)
+                downloads = result.get('requested_downloads') or [{}]
+                send({"type": "result", "data": {"info": ydl.sanitize_info(result), "filepath": downloads[0].get('filepath')}})
+
+            else:
+                send({"type": "error", "message": f"unknown op: {job['op']}"})
+        except Exception as e:
+            send({"type": "error", "message": str(e)})
+
+if __name__ == "__main__":
+    main()